@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Benchmarks of the bot's hot paths that run without a discord connection.
+# Usage: bench.py [list|loot|autocomplete|time ...], without arguments every benchmark runs.
+# Run it from this directory, the database helpers read config.json and the loot cog reads ../data.
+
+import gettext
+import logging
+import random
+import sqlite3
+import sys
+import time
+
+from database import config, create_table, explain_order, nth_raid_query, read_config_key, select_order, signed_up_query
+
+# The cogs and the time parser translate their strings, they are imported by the benchmarks that need them
+gettext.NullTranslations().install()
+
+
+def bench_list_queries(sizes=(200, 2000, 20000), repeat=200, guilds=100):
+    """ seed in-memory databases with raids and time the /list_players and /list_raids queries
+
+    Returns the mean ms of both queries per number of raids and the query plans at the largest size.
+    """
+    rng = random.Random(0)
+    stats = {}
+    plans = {}
+    for size in sizes:
+        conn = sqlite3.connect(':memory:')
+        for table in ['raid', 'player', 'raid_time_index', 'raid_guild_index', 'player_index']:
+            create_table(conn, table)
+        now = int(time.time())
+        raids = [(raid_id, raid_id % guilds, raid_id % guilds, 0, "Raid", now + rng.randrange(86400 * 30), False)
+                 for raid_id in range(size)]
+        conn.executemany("insert into Raids (raid_id, channel_id, guild_id, organizer_id, name, time, roster) "
+                         "values (?, ?, ?, ?, ?, ?, ?);", raids)
+        # Six sign ups per raid from as many players as raids, so a player's sign ups do not grow with the table
+        players = [(raid_id, player_id, str(player_id), now, rng.random() < 0.1)
+                   for raid_id in range(size) for player_id in rng.sample(range(size), min(6, size))]
+        conn.executemany("insert into Players (raid_id, player_id, byname, timestamp, unavailable) "
+                         "values (?, ?, ?, ?, ?);", players)
+        conn.commit()
+        timings = []
+        for query in [lambda: nth_raid_query(rng.randrange(guilds), 2), lambda: signed_up_query(rng.randrange(size))]:
+            start = time.perf_counter()
+            for i in range(repeat):
+                select_order(conn, *query())
+            timings.append((time.perf_counter() - start) / repeat * 1000)
+        stats[size] = tuple(timings)
+        plans = {'list_players': explain_order(conn, *nth_raid_query(0, 2)),
+                 'list_raids': explain_order(conn, *signed_up_query(0))}
+        conn.close()
+    return stats, plans
+
+
+def check_list_queries():
+    stats, plans = bench_list_queries()
+    for size, (players_time, raids_time) in stats.items():
+        print("{0} raids: list_players {1:.3f} ms, list_raids {2:.3f} ms".format(size, players_time, raids_time))
+    for name, plan in plans.items():
+        print("{0}: {1}".format(name, "; ".join(plan)))
+    assert any('Raids_guild_time' in detail for detail in plans['list_players']), plans['list_players']
+    assert any('Players_player' in detail for detail in plans['list_raids']), plans['list_raids']
+    # A hundred times the raids may cost a little, a scan would cost about a hundred times as much
+    smallest, largest = stats[min(stats)], stats[max(stats)]
+    for name, small, large in zip(['list_players', 'list_raids'], smallest, largest):
+        assert large < 3 * small + 0.05, "{0} grows with the table: {1:.3f} ms -> {2:.3f} ms".format(name, small, large)
+
+
+def bench_loot(data, level=160):
+    """ resolve every container for every class, returns the number of resolutions and the time taken """
+    from treasure_cog import Classes, resolveLoot
+    resolved = 0
+    start = time.perf_counter()
+    for containerID in data.containers:
+        for _class in Classes:
+            resolveLoot(data, containerID, _class.name, level, False)
+            resolved += 1
+    return resolved, time.perf_counter() - start
+
+
+def check_loot():
+    from treasure_cog import loadLootSnapshot
+    snapshot = loadLootSnapshot()
+    resolved, duration = bench_loot(snapshot.data)
+    print("Resolved {0} drop tables in {1:.2f} s ({2:.0f} \u00b5s each).".format(
+        resolved, duration, duration / max(resolved, 1) * 1e6))
+
+
+def bench_autocomplete(snapshot, samples=50):
+    """ time container autocomplete through the trigram index against a full fuzzy scan
+
+    Returns the number of queries, the mean and worst times of both in ms and how many results agree.
+    """
+    from utils import get_partial_matches
+    containers = snapshot.containers
+    names = random.sample(list(containers.values()), min(samples, len(containers)))
+    queries = []
+    for name in names:
+        queries.extend([name[:2], name[:4], name[:8], name[len(name)//3:len(name)//3 + 6]])
+    agree = 0
+    times = {'scan': [], 'index': []}
+    for query in queries:
+        start = time.perf_counter()
+        expected = get_partial_matches(query, containers, keys=True)
+        times['scan'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        result = snapshot.containerIndex.search(query)
+        times['index'].append(time.perf_counter() - start)
+        if set(result) == set(expected):
+            agree += 1
+    stats = {method: (sum(t) / len(t) * 1000, max(t) * 1000) for method, t in times.items()}
+    return len(queries), stats, agree
+
+
+def check_autocomplete():
+    from treasure_cog import loadLootSnapshot
+    queries, stats, agree = bench_autocomplete(loadLootSnapshot())
+    print("{0} queries, {1}/{0} identical result sets.".format(queries, agree))
+    for method, (mean, worst) in stats.items():
+        print("{0}: {1:.2f} ms mean, {2:.2f} ms worst".format(method, mean, worst))
+
+
+def latency(timings):
+    """ mean and p99 in ms """
+    if not timings:
+        return 0.0, 0.0
+    timings = sorted(timings)
+    p99 = timings[min(int(len(timings) * 0.99), len(timings) - 1)]
+    return sum(timings) / len(timings) * 1000, p99 * 1000
+
+
+def bench_time_parser(tz_name='Europe/London', languages=('en',), repeat=5):
+    """ time every corpus entry through parse_time and dateparser alone
+
+    Returns the mean and p99 time per parse in ms of the fast path, parse_time with a cold cache,
+    dateparser restricted to the languages and dateparser trying all languages,
+    and the number of fast path and restricted results that differ from dateparser.
+    """
+    import datetime
+    import pytz
+    from time_parser import (dateparser_parse, fast_parse, get_date_parsers, normalize, parse_cache, parse_time,
+                             time_corpus)
+    now = time.time()
+    now -= now % 60
+    server = _("server")
+    entries = []
+    for text in time_corpus:
+        text = normalize(text)
+        if server in text:
+            text = text.partition(server)[0].strip()
+        entries.append(text)
+    parsers = get_date_parsers(languages)
+    # Load the locale data of every language first so it is not counted against the first entries
+    parsers.warm_up()
+    for text in entries:
+        dateparser_parse(text, tz_name, now)
+    mismatches = 0
+    fast = []
+    tz = pytz.timezone(tz_name)
+    base = datetime.datetime.fromtimestamp(now, tz=tz).replace(tzinfo=None)
+    for text in entries:
+        expected = dateparser_parse(text, tz_name, now)
+        restricted = parsers.parse(text, tz_name, now)
+        if (expected is None) != (restricted is None) or (expected and expected != restricted):
+            mismatches += 1
+        start = time.perf_counter()
+        for i in range(repeat):
+            result = fast_parse(text, base)
+        if result is None:
+            continue
+        fast.append((time.perf_counter() - start) / repeat)
+        if result.tzinfo is None:
+            result = tz.localize(result)
+        if expected is None or result.timestamp() != expected.timestamp():
+            mismatches += 1
+    timings = {'fast path': fast, 'parse_time': [], 'dateparser restricted': [], 'dateparser': []}
+    for i in range(repeat):
+        parse_cache.clear()
+        parsers.zoned.clear()
+        for text in entries:
+            start = time.perf_counter()
+            parse_time(text, tz_name, now, languages)
+            timings['parse_time'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            parsers.parse(text, tz_name, now)
+            timings['dateparser restricted'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            dateparser_parse(text, tz_name, now)
+            timings['dateparser'].append(time.perf_counter() - start)
+    stats = {method: latency(t) for method, t in timings.items()}
+    return len(entries), len(fast), stats, mismatches
+
+
+def check_time_parser():
+    from time_parser import bot_languages
+    languages = bot_languages(read_config_key(config, 'LANGUAGE', False))
+    entries, fast, stats, mismatches = bench_time_parser(languages=languages)
+    print("{0} arguments, {1} handled by the fast path, {2} results differing from dateparser.".format(
+        entries, fast, mismatches))
+    for method, (mean, p99) in stats.items():
+        print("{0}: {1:.3f} ms mean, {2:.3f} ms p99".format(method, mean, p99))
+
+
+benchmarks = {'list': check_list_queries, 'loot': check_loot, 'autocomplete': check_autocomplete,
+              'time': check_time_parser}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    for name in sys.argv[1:] or benchmarks:
+        print("Running the {0} benchmark.".format(name))
+        benchmarks[name]()
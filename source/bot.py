@@ -1,4 +1,6 @@
 import aiohttp
+import asyncio
+from collections import defaultdict
 from datetime import datetime
 import discord
 from discord.ext import commands
@@ -11,11 +13,14 @@ import os
 import re
 
 from database import create_connection, create_table, increment, read_config_key, select, upsert
+from db_service import connect_to_service
+from utils import SingleFlight
+from time_parser import bot_languages, get_date_parsers
 
 
-class Bot(commands.Bot):
+class Bot(commands.AutoShardedBot):
 
-    def __init__(self):
+    def __init__(self, shard_ids=None, shard_count=None, db_socket=None):
         self.launch_time = datetime.utcnow()
 
         version = ""
@@ -68,6 +73,23 @@ class Bot(commands.Bot):
         else:
             self.creep_id = None
 
+        # Sharding, discord decides the number of shards if not specified
+        if not shard_count:
+            shard_count = read_config_key(config, 'SHARD_COUNT', False)
+        if shard_count:
+            shard_count = int(shard_count)
+        self.shard_metrics = defaultdict(dict)
+        # Concurrent fetches of the same url share one request
+        self.single_flight = SingleFlight()
+
+        # Reload lotro-data when it changes, interval in seconds
+        self.loot_watch = read_config_key(config, 'LOOT_WATCH', False)
+
+        # Calendar feeds for calendar apps, served when a port is configured
+        self.ical_port = read_config_key(config, 'ICAL_PORT', False)
+        self.ical_url = read_config_key(config, 'ICAL_URL', False)
+        self.ical_secret = read_config_key(config, 'ICAL_SECRET', False)
+
         # Check for twitter auth
         self.twitter_token = read_config_key(config, 'TWITTER_TOKEN', False)
         self.twitter_id = read_config_key(config, 'TWITTER_ID', False)
@@ -81,8 +103,14 @@ class Bot(commands.Bot):
         else:
             logger.warning("Language file '{0}' not found. Defaulting to English.".format(language))
         localization.install()
+        # Languages time arguments are parsed in
+        self.languages = bot_languages(language)
 
-        conn = create_connection('raid_db')
+        if db_socket:
+            # Cluster mode, the database service owns all writes
+            conn = connect_to_service(db_socket, 'raid_db')
+        else:
+            conn = create_connection('raid_db')
         if conn:
             self.logger.info("Bot connected to raid database.")
             create_table(conn, 'settings')
@@ -94,9 +122,11 @@ class Bot(commands.Bot):
         intents.guilds = True
         intents.emojis = True
         intents.dm_messages = True
+        # Keeps the guild scheduled events cached
+        intents.guild_scheduled_events = True
 
         super().__init__(command_prefix=self.prefix_manager, case_insensitive=True, intents=intents,
-                         activity=discord.Game(name=self.version))
+                         activity=discord.Game(name=self.version), shard_count=shard_count, shard_ids=shard_ids)
 
         async def globally_block_dms(ctx):
             if ctx.guild is None and not await ctx.bot.is_owner(ctx.author):
@@ -109,6 +139,31 @@ class Bot(commands.Bot):
     def prefix_manager(self, bot, message):
         return commands.when_mentioned_or("!")(bot, message)
 
+    def shard_id_for(self, guild_id):
+        return (guild_id >> 22) % (self.shard_count or 1)
+
+    def is_local_guild(self, guild_id):
+        return self.shard_id_for(guild_id) in self.shards
+
+    def is_primary(self):
+        """ whether this bot runs the tasks shared by the whole cluster """
+        return self.shard_ids is None or 0 in self.shard_ids
+
+    def partition_by_shard(self, rows, index=0, local_only=True):
+        """ group rows by the shard of the guild id at index, by default only for shards run by this bot """
+        if local_only:
+            partitions = {shard_id: [] for shard_id in self.shards}
+        else:
+            partitions = {shard_id: [] for shard_id in range(self.shard_count or 1)}
+        for row in rows:
+            shard_id = self.shard_id_for(row[index])
+            if shard_id in partitions:
+                partitions[shard_id].append(row)
+        return partitions
+
+    def record_shard_metric(self, shard_id, name, duration):
+        self.shard_metrics[shard_id][name] = duration
+
     async def on_ready(self):
         self.logger.info("We have logged in as {0}.".format(self.user))
         if not self.guilds:
@@ -148,6 +203,27 @@ class Bot(commands.Bot):
             await self.load_extension('custom_cog')
         except commands.ExtensionAlreadyLoaded:
             pass
+        # Load ical cog last, every worker answers /ics and one serves the feeds of the whole cluster
+        if self.ical_port:
+            try:
+                await self.load_extension('ical_cog')
+            except commands.ExtensionAlreadyLoaded:
+                pass
+            except commands.ExtensionFailed as e:
+                # Such as the port being in use, the bot works without the feeds
+                self.logger.error("Failed to load ical cog.")
+                self.logger.error(e.original, exc_info=e.original)
+
+        # Load the date parser languages in the background instead of on the first command
+        self.warm_up_task = asyncio.create_task(self.warm_up_parsers())
+
+    async def warm_up_parsers(self):
+        for languages in (self.languages, ['en']):
+            parsers = get_date_parsers(languages)
+            if parsers.warm:
+                continue
+            duration = await asyncio.to_thread(parsers.warm_up)
+            self.logger.info("Warmed up date parser for {0} in {1:.2f} s.".format(languages, duration))
 
     async def on_command_error(self, ctx, error):
         if isinstance(error, commands.NoPrivateMessage):
@@ -1,19 +1,26 @@
-import dateparser
+import aiohttp
+import asyncio
 import discord
+import hashlib
+import json
 import logging
-import pytz
-import re
+import time
 
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 
-from database import select_one, select_order, upsert
-from utils import chunks
+from database import create_table, select_one, select_order, upsert
+from event_schedule import event_url, parse_schedule, upcoming_events
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Raids per calendar message and their total length, within discord's 25 fields and 6000 characters per embed
+calendar_page_size = 20
+calendar_page_length = 5000
+
 
 @app_commands.guild_only()
 class CalendarGroup(app_commands.Group):
@@ -26,8 +33,21 @@ class CalendarCog(commands.Cog):
         self.bot = bot
         self.conn = bot.conn
         self.time_cog = bot.get_cog('TimeCog')
-        self.upcoming_events = None
+        create_table(self.conn, 'event_schedule')
+        self.events = None
         self.cached_events_at = None
+        self.refresh_task = None
+        # Content hash of each calendar page by message id
+        self.calendar_hashes = {}
+        # Serializes posting and updating the calendar of a guild, concurrent updates would post the same pages
+        self.calendar_locks = defaultdict(asyncio.Lock)
+        self.load_events()
+
+    async def cog_load(self):
+        self.events_task.start()
+
+    async def cog_unload(self):
+        self.events_task.cancel()
 
     def is_raid_leader(self, user, guild):
         if user.guild_permissions.administrator:
@@ -40,55 +60,87 @@ class CalendarCog(commands.Cog):
         return False
 
     async def post_calendar(self, guild_id, channel):
-        embed = self.calendar_embed(guild_id)
-        msg = await channel.send(embed=embed)
-        ids = "{0}/{1}".format(channel.id, msg.id)
-        res = upsert(self.conn, 'Settings', ['calendar'], [ids], ['guild_id'], [guild_id])
-        self.conn.commit()
+        async with self.calendar_locks[guild_id]:
+            ids = [str(channel.id)]
+            pages = self.calendar_pages(guild_id)
+            for page, fields in enumerate(pages):
+                msg = await channel.send(embed=self.calendar_embed(fields, page, len(pages)))
+                self.calendar_hashes[msg.id] = self.page_hash(fields, page, len(pages))
+                ids.append(str(msg.id))
+            res = upsert(self.conn, 'Settings', ['calendar'], ["/".join(ids)], ['guild_id'], [guild_id])
+            self.conn.commit()
 
     async def update_calendar(self, guild_id):
-        conn = self.bot.conn
-        res = select_one(conn, 'Settings', ['calendar'], ['guild_id'], [guild_id])
-        if not res:
-            return
-        result = res.split("/")
-        chn_id = int(result[0])
-        msg_id = int(result[1])
-        chn = self.bot.get_channel(chn_id)
-        try:
-            msg = chn.get_partial_message(msg_id)
-        except AttributeError:
-            logger.warning("Calendar channel not found for guild {0}.".format(guild_id))
-            res = upsert(conn, 'Settings', ['calendar'], [None], ['guild_id'], [guild_id])
-            if res:
+        async with self.calendar_locks[guild_id]:
+            conn = self.bot.conn
+            res = select_one(conn, 'Settings', ['calendar'], ['guild_id'], [guild_id])
+            if not res:
+                return
+            result = res.split("/")
+            chn_id = int(result[0])
+            msg_ids = [int(msg_id) for msg_id in result[1:]]
+            chn = self.bot.get_channel(chn_id)
+            if not chn:
+                logger.warning("Calendar channel not found for guild {0}.".format(guild_id))
+                res = upsert(conn, 'Settings', ['calendar'], [None], ['guild_id'], [guild_id])
+                if res:
+                    conn.commit()
+                return
+
+            pages = self.calendar_pages(guild_id)
+            ids = list(msg_ids)
+            try:
+                for page, fields in enumerate(pages):
+                    page_hash = self.page_hash(fields, page, len(pages))
+                    if page < len(ids):
+                        # Only edit the pages whose rows changed
+                        if self.calendar_hashes.get(ids[page]) != page_hash:
+                            embed = self.calendar_embed(fields, page, len(pages))
+                            try:
+                                await chn.get_partial_message(ids[page]).edit(embed=embed)
+                            except discord.NotFound:
+                                # Someone deleted this page, post it again
+                                self.calendar_hashes.pop(ids[page], None)
+                                msg = await chn.send(embed=embed)
+                                ids[page] = msg.id
+                    else:
+                        msg = await chn.send(embed=self.calendar_embed(fields, page, len(pages)))
+                        ids.append(msg.id)
+                    self.calendar_hashes[ids[page]] = page_hash
+                while len(ids) > len(pages):
+                    msg_id = ids[-1]
+                    self.calendar_hashes.pop(msg_id, None)
+                    try:
+                        await chn.get_partial_message(msg_id).delete()
+                    except discord.NotFound:
+                        # Already gone
+                        pass
+                    ids.pop()
+            except discord.Forbidden:
+                logger.warning("Calendar access restricted for guild {0}.".format(guild_id))
+            except discord.NotFound:
+                # Pages that are gone are handled above, this is the channel
+                logger.warning("Calendar channel not found for guild {0}.".format(guild_id))
+                upsert(conn, 'Settings', ['calendar'], [None], ['guild_id'], [guild_id])
+                conn.commit()
+                return
+            except discord.HTTPException as e:
+                logger.warning("Failed to update calendar for guild {0}.".format(guild_id))
+                logger.warning(e)
+            if ids != msg_ids:
+                # Pages were added or removed
+                ids = "/".join(str(_id) for _id in [chn_id] + ids)
+                upsert(conn, 'Settings', ['calendar'], [ids], ['guild_id'], [guild_id])
                 conn.commit()
-            return
-
-        embed = self.calendar_embed(guild_id)
-        try:
-            await msg.edit(embed=embed)
-        except discord.Forbidden:
-            logger.warning("Calendar access restricted for guild {0}.".format(guild_id))
-            return
-        except discord.NotFound:
-            logger.warning("Calendar post not found for guild {0}.".format(guild_id))
-            upsert(conn, 'Settings', ['calendar'], [None], ['guild_id'], [guild_id])
-            conn.commit()
-            return
-        except discord.HTTPException as e:
-            logger.warning("Failed to update calendar for guild {0}.".format(guild_id))
-            logger.warning(e)
-            return
 
-    def calendar_embed(self, guild_id):
+    def calendar_pages(self, guild_id):
+        """ the (name, value) fields of every raid in the guild, split into pages that fit one embed """
         conn = self.bot.conn
         raids = select_order(conn, 'Raids', ['channel_id', 'raid_id', 'name', 'tier', 'time'], 'time', ['guild_id'],
                              [guild_id])
-
-        title = _("Scheduled runs:")
-        desc = _("Click the link to sign up!")
-        embed = discord.Embed(title=title, description=desc, colour=discord.Colour(0x3498db))
-        for raid in raids[:20]:
+        pages = [[]]
+        length = 0
+        for raid in raids:
             timestamp = int(raid[4])
             tier = raid[3]
             if tier:
@@ -97,7 +149,26 @@ class CalendarCog(commands.Cog):
             else:
                 msg = "[{name}](<https://discord.com/channels/{guild}/{channel}/{msg}>)\n".format(
                 guild=guild_id, channel=raid[0], msg=raid[1], name=raid[2])
-            embed.add_field(name=f"<t:{timestamp}:F>", value=msg, inline=False)
+            field = (f"<t:{timestamp}:F>", msg)
+            if len(pages[-1]) == calendar_page_size or length + len(field[0]) + len(field[1]) > calendar_page_length:
+                pages.append([])
+                length = 0
+            pages[-1].append(field)
+            length += len(field[0]) + len(field[1])
+        return pages
+
+    @staticmethod
+    def page_hash(fields, page, pages):
+        return hashlib.sha1(repr((fields, page, pages)).encode()).hexdigest()
+
+    def calendar_embed(self, fields, page=0, pages=1):
+        title = _("Scheduled runs:")
+        if pages > 1:
+            title = "{0} ({1}/{2})".format(title.rstrip(" :"), page + 1, pages)
+        desc = _("Click the link to sign up!") if page == 0 else None
+        embed = discord.Embed(title=title, description=desc, colour=discord.Colour(0x3498db))
+        for name, value in fields:
+            embed.add_field(name=name, value=value, inline=False)
         embed.set_footer(text=_("Last updated"))
         embed.timestamp = datetime.now()
         return embed
@@ -122,6 +193,10 @@ class CalendarCog(commands.Cog):
         except discord.Forbidden:
             logger.warning("Missing manage events permission for guild {0}".format(guild.id))
             event_id = None
+        except discord.HTTPException as e:
+            # Discord refuses events starting in the past
+            logger.warning("Failed to create guild event for raid {0}: {1}".format(raid_id, e))
+            event_id = None
         else:
             event_id = event.id
         return event_id
@@ -135,18 +210,31 @@ class CalendarCog(commands.Cog):
         if not event_id:
             return
 
-        # discord.py does not have partial event
-        event = await guild.fetch_scheduled_event(event_id, with_counts=False)
         start_time = datetime.fromtimestamp(timestamp, tz=timezone.utc)
         end_time = datetime.fromtimestamp(timestamp+7200, tz=timezone.utc)
         if tier:
             event_name = " ".join([name, tier])
         else:
             event_name = name
+        # The gateway keeps the guild's scheduled events up to date, skip edits that change nothing
+        event = guild.get_scheduled_event(event_id)
+        if event and (event.name, event.description or None, event.start_time, event.end_time) == \
+                (event_name, description or None, start_time, end_time):
+            return
+        # Partial edit by id, discord.py would need the full event
         try:
-            await event.edit(name=event_name, description=description, start_time=start_time, end_time=end_time)
+            await self.bot.http.edit_scheduled_event(guild.id, event_id, name=event_name, description=description,
+                                                     scheduled_start_time=start_time.isoformat(),
+                                                     scheduled_end_time=end_time.isoformat())
         except discord.Forbidden:
             logger.warning("Missing manage events permission for guild {0}".format(guild.id))
+        except discord.NotFound:
+            logger.info("Guild event for raid {0} was deleted in discord.".format(raid_id))
+            upsert(conn, 'Raids', ['event_id'], [None], ['raid_id'], [raid_id])
+            conn.commit()
+        except discord.HTTPException as e:
+            # Discord refuses some edits, such as the start time of an active event
+            logger.warning("Failed to edit guild event for raid {0}: {1}".format(raid_id, e))
 
     async def delete_guild_event(self, guild, raid_id):
         conn = self.bot.conn
@@ -154,58 +242,88 @@ class CalendarCog(commands.Cog):
         if not event_id:
             return
 
-        # discord.py does not have partial event
-        event = await guild.fetch_scheduled_event(event_id, with_counts=False)
         try:
-            await event.delete()
+            await self.bot.http.delete_scheduled_event(guild.id, event_id)
         except discord.Forbidden:
             logger.warning("Missing manage events permission for guild {0}".format(guild.id))
-
-    async def get_events(self):
-        current_time = datetime.now().timestamp()
-        if self.cached_events_at and self.cached_events_at + 86400 > current_time:
-            return self.upcoming_events
-
-        event_url = "https://www.lotro.com/news/lotro-public-event-schedule-en"
-        async with self.bot.http_session.get(event_url) as resp:
-            if not resp.ok:
-                logger.warning("Could not connect to lotro.com")
-                return self.upcoming_events
+        except discord.NotFound:
+            pass
+
+    def load_events(self):
+        """ the last scraped schedule, so a restart does not have to scrape it again """
+        res = select_one(self.conn, 'EventSchedule', ['fetched_at', 'events'], ['url'], [event_url])
+        if res:
+            self.cached_events_at = res[0]
+            self.events = [tuple(event) for event in json.loads(res[1])]
+
+    async def refresh_events(self):
+        """ fetch the schedule if it changed since the last scrape, concurrent callers share one request """
+        await self.bot.single_flight.do(event_url, self.fetch_events)
+
+    async def fetch_events(self):
+        headers = {}
+        res = select_one(self.conn, 'EventSchedule', ['etag', 'last_modified'], ['url'], [event_url])
+        if res and self.events is not None:
+            etag, last_modified = res
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        async with self.bot.http_session.get(event_url, headers=headers) as resp:
+            if resp.status == 304:
+                self.cached_events_at = int(time.time())
+                upsert(self.conn, 'EventSchedule', ['fetched_at'], [self.cached_events_at], ['url'], [event_url])
+                self.conn.commit()
+                return
+            resp.raise_for_status()
             text = await resp.text()
+            etag = resp.headers.get('ETag')
+            last_modified = resp.headers.get('Last-Modified')
 
-        stripped = re.sub('<[^<]+?>', '', text)
-        stripped = stripped.replace('\xa0', '')
-        stripped = stripped.replace('&gt;', '>')
-        # Let us hope this questionable pattern is stable enough
-        pattern = r'ALL TIMES EASTERN/SERVER TIME(.*)Ends \(Eastern Time\)(.*)Share On:'
-
-        prog = re.compile(pattern, flags=re.DOTALL)
-        result = prog.search(stripped)
-        events_data = result.group(2).strip().splitlines() + ['']
-        events = [chunk for chunk in chunks(events_data, 5)]
-        parsed_events = [(event[0], self.parse_event_time(event[1]), self.parse_event_time(event[2])) for event in events]
-
-        cutoff_unlock = current_time - 30 * 86400
-        cutoff_past = current_time - 86400
-        cutoff_future = current_time + 60 * 86400
-
-        upcoming_events = []
-        for event in parsed_events:
-            start_time = current_time
-            if event[1]:
-                start_time = event[1]
-            if event[2]:
-                if cutoff_past < event[2] and start_time < cutoff_future:
-                    upcoming_events.append(event)
-            else:
-                if cutoff_unlock < start_time < cutoff_future:
-                    upcoming_events.append(event)
-            if start_time > cutoff_future:
-                break
+        result = await asyncio.to_thread(parse_schedule, text)
+        if result is None:
+            logger.warning("Event schedule not found on lotro.com.")
+            return
+        events, errors = result
+        for number, message in errors:
+            logger.warning("Event schedule row {0}: {1}".format(number, message))
+        self.events = events
+        self.cached_events_at = int(time.time())
+        upsert(self.conn, 'EventSchedule', ['etag', 'last_modified', 'fetched_at', 'events'],
+               [etag, last_modified, self.cached_events_at, json.dumps(events)], ['url'], [event_url])
+        self.conn.commit()
 
-        self.cached_events_at = current_time
-        self.upcoming_events = upcoming_events
-        return upcoming_events
+    async def revalidate_events(self):
+        try:
+            await self.refresh_events()
+        except aiohttp.ClientError:
+            logger.warning("Could not connect to lotro.com")
+
+    async def get_events(self):
+        current_time = datetime.now().timestamp()
+        if self.events is None:
+            # Nothing scraped yet
+            await self.revalidate_events()
+            if self.events is None:
+                return []
+        elif self.cached_events_at + 86400 < current_time and event_url not in self.bot.single_flight.calls:
+            # Serve the stale schedule and revalidate in the background
+            self.refresh_task = asyncio.create_task(self.revalidate_events())
+        return upcoming_events(self.events, current_time)
+
+    @tasks.loop(hours=1)
+    async def events_task(self):
+        await self.refresh_events()
+        logger.debug("Completed event schedule background task.")
+
+    @events_task.before_loop
+    async def before_events_task(self):
+        await self.bot.wait_until_ready()
+
+    @events_task.error
+    async def handle_error(self, exception):
+        logger.error("Event schedule task failed.")
+        logger.error(exception, exc_info=True)
 
     async def events_embed(self, guild_id):
         events = await self.get_events()
@@ -222,27 +340,18 @@ class CalendarCog(commands.Cog):
                 if e[2]:
                     time_str = f"At <t:{e[2]}>"
             embed.add_field(name=e[0], value=time_str, inline=False)
-        embed.set_footer(text=_("Last updated"))
-        embed.timestamp = datetime.fromtimestamp(self.cached_events_at)
+        if self.cached_events_at:
+            embed.set_footer(text=_("Last updated"))
+            embed.timestamp = datetime.fromtimestamp(self.cached_events_at)
         return embed
 
-    def parse_event_time(self, time_string):
-        if not time_string:
-            return None
-        time_string = time_string.casefold()
-        time_string = time_string.replace(" eastern", "")
-        time_string = time_string.replace("approximately ", "")
-        time = dateparser.parse(time_string)
-        try:
-            time = pytz.timezone("America/New_York").localize(time).timestamp()
-        except:
-            logger.info(f"Calendar failed to parse: {time_string}")
-            return None
-        return int(time)
-
     @app_commands.command(name=_("events"), description=_("Shows upcoming official LotRO events in your local time."))
     @app_commands.guild_only()
     async def events_respond(self, interaction: discord.Interaction):
+        if self.events is not None:
+            events = await self.events_embed(interaction.guild_id)
+            await interaction.response.send_message(embed=events)
+            return
         await interaction.response.send_message(_("Waiting for lotro.com to respond..."))
         events = await self.events_embed(interaction.guild_id)
         await interaction.edit_original_response(content='', embed=events)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Runs the bot as several shard worker processes.
+# A single database service process owns all writes to the raid database.
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from database import read_config_key
+from db_service import DatabaseService
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def run_database_service(db_file, socket_path):
+    logging.basicConfig(filename='db_service.log', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    service = DatabaseService(db_file, socket_path)
+    asyncio.run(service.serve())
+
+
+def run_worker(index, shard_ids, shard_count, socket_path):
+    from bot import Bot
+    bot = Bot(shard_ids=shard_ids, shard_count=shard_count, db_socket=socket_path)
+    handler = logging.FileHandler(filename='discordpy-{0}.log'.format(index), encoding='utf-8', mode='w')
+    bot.run(bot.token, log_handler=handler)
+    bot.logger.info("Shutting down worker {0}.".format(index))
+
+
+def main():
+    config = None
+    try:
+        with open('config.json', 'r') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        logger.warning(f"No config file found. Please create the file 'config.json', see GitHub for an example.")
+    shard_count = int(read_config_key(config, 'SHARD_COUNT', True))
+    worker_count = int(read_config_key(config, 'CLUSTER_WORKERS', True))
+    socket_path = read_config_key(config, 'DB_SOCKET', False)
+    if not socket_path:
+        socket_path = 'raid_db.sock'
+    try:
+        os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+
+    service = multiprocessing.Process(target=run_database_service, args=('raid_db', socket_path), daemon=True)
+    service.start()
+    while not os.path.exists(socket_path):
+        if not service.is_alive():
+            logger.critical("Database service failed to start.")
+            raise SystemExit
+        time.sleep(0.1)
+
+    workers = []
+    for index in range(worker_count):
+        shard_ids = list(range(index, shard_count, worker_count))
+        worker = multiprocessing.Process(target=run_worker, args=(index, shard_ids, shard_count, socket_path))
+        worker.start()
+        workers.append(worker)
+    # Without the database service every write would be lost, stop the workers when it dies
+    while any(worker.is_alive() for worker in workers):
+        if not service.is_alive():
+            logger.critical("Database service stopped with exit code {0}, stopping the workers.".format(service.exitcode))
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
+            raise SystemExit(1)
+        time.sleep(1)
+    service.terminate()
+
+
+if __name__ == '__main__':
+    main()
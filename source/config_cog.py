@@ -1,3 +1,4 @@
+import aiohttp
 import datetime
 import discord
 import logging
@@ -38,6 +39,16 @@ class ConfigCog(commands.Cog):
 
         return ", ".join(strings)
 
+    async def get_latest_version(self, releases):
+        async with self.bot.http_session.get(releases, allow_redirects=False) as r:
+            r.raise_for_status()
+            try:
+                location = r.headers['location']
+            except KeyError:
+                return "N/A"
+            (x, y, latest_version) = location.rpartition('/')
+            return latest_version
+
     async def about_embed(self):
         dev = "Baviaan#4862"
         repo = "https://github.com/Baviaan/lotro"
@@ -55,16 +66,10 @@ class ConfigCog(commands.Cog):
                       "%20applications.commands".format(self.bot.user.id)
         #donate_link = "https://www.paypal.com/donate?hosted_button_id=WWPCUJVJPMT7W"
         releases = repo + "/releases/latest"
-        async with  self.bot.http_session.get(releases, allow_redirects=False) as r:
-            if r.ok:
-                try:
-                    location = r.headers['location']
-                except KeyError:
-                    latest_version = "N/A"
-                else:
-                    (x, y, latest_version) = location.rpartition('/')
-            else:
-                latest_version = "N/A"
+        try:
+            latest_version = await self.bot.single_flight.do(releases, lambda: self.get_latest_version(releases))
+        except aiohttp.ClientError:
+            latest_version = "N/A"
 
         title = "{0}".format(self.bot.user)
         about = [
@@ -124,10 +124,24 @@ def table_sqls(table):
                         "post_id integer"
                         ");",
 
+            'event_schedule': "create table if not exists EventSchedule ("
+                              "url text primary key, "
+                              "etag text, "
+                              "last_modified text, "
+                              "fetched_at integer, "
+                              "events text"
+                              ");",
+
             'specs': "create table if not exists Specs ("
                      "player_id integer primary key, "
                      "{0}"
-                     ");".format(specs_str)
+                     ");".format(specs_str),
+
+            'raid_time_index': "create index if not exists Raids_time on Raids (time);",
+
+            'raid_guild_index': "create index if not exists Raids_guild_time on Raids (guild_id, time);",
+
+            'player_index': "create index if not exists Players_player on Players (player_id, unavailable);",
     }
     return sql_dict[table]
 
@@ -145,20 +159,20 @@ def upsert(conn, table, columns, values, where_columns=None, where_values=None):
         update_values = values
     updates.append(";")
     sql_update = " ".join(updates)
+    if where_columns:
+        insert_columns = columns + where_columns
+        insert_values = values + where_values
+    else:
+        insert_columns = columns
+        insert_values = values
+    # Insert only if the update changed nothing, so the caller does not have to wait for the update's row count
+    inserts = ["insert into {0} (".format(table), ", ".join(insert_columns), ") select",
+               ", ".join("?" * len(insert_values)), "where changes() = 0;"]
+    sql_insert = " ".join(inserts)
     try:
         c = conn.cursor()
         c.execute(sql_update, update_values)
-        if c.rowcount == 0:
-            if where_columns:
-                insert_columns = columns + where_columns
-                insert_values = values + where_values
-            else:
-                insert_columns = columns
-                insert_values = values
-            inserts = ["insert into {0} (".format(table), ", ".join(insert_columns), ") values (",
-                       ", ".join("?" * len(insert_values)), ");"]
-            sql_insert = " ".join(inserts)
-            c.execute(sql_insert, insert_values)
+        c.execute(sql_insert, insert_values)
         return True
     except sqlite3.Error as e:
         logger.exception(e)
@@ -199,6 +213,22 @@ def delete(conn, table, where_columns, where_values):
         logger.info(sql_delete)
 
 
+def delete_in(conn, table, column, values, chunk_size=500):
+    """ delete all records with column in values """
+    values = list(values)
+    sql_delete = ""
+    try:
+        c = conn.cursor()
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i:i + chunk_size]
+            sql_delete = "delete from {0} where {1} in ({2});".format(table, column, ", ".join("?" * len(chunk)))
+            c.execute(sql_delete, chunk)
+        return True
+    except sqlite3.Error as e:
+        logger.exception(e)
+        logger.info(sql_delete)
+
+
 def select(conn, table, columns, where_columns=None, where_values=None):
     selects = ["select", ", ".join(columns), "from {0}".format(table)]
     if where_columns:
@@ -220,6 +250,25 @@ def select(conn, table, columns, where_columns=None, where_values=None):
         logger.info(sql_select)
 
 
+def select_in(conn, table, columns, column, values, chunk_size=500):
+    """ select all records with column in values """
+    values = list(values)
+    sql_select = ""
+    result = []
+    try:
+        c = conn.cursor()
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i:i + chunk_size]
+            sql_select = "select {0} from {1} where {2} in ({3});".format(", ".join(columns), table, column,
+                                                                          ", ".join("?" * len(chunk)))
+            c.execute(sql_select, chunk)
+            result.extend(c.fetchall())
+        return result
+    except sqlite3.Error as e:
+        logger.exception(e)
+        logger.info(sql_select)
+
+
 def select_one(conn, table, columns, eq_columns=None, eq_values=None, none_columns=None, like_columns=None, like_values=None):
     selects = ["select", ", ".join(columns), "from {0}".format(table)]
     if eq_columns or none_columns or like_columns:
@@ -259,18 +308,30 @@ def select_one(conn, table, columns, eq_columns=None, eq_values=None, none_colum
         logger.info(sql_select)
 
 
-def select_order(conn, table, columns, order, where_columns=None, where_values=None):
+def order_sql(table, columns, order, where_columns=None, where_values=None, limit=None, offset=None):
     selects = ["select", ", ".join(columns), "from {0}".format(table)]
     if where_columns:
         assert len(where_columns) == len(where_values)
         selects.append("where")
         selects.append(" and ".join(["=".join([column, "?"]) for column in where_columns]))
-    selects.append("order by {0};".format(order))
-    sql_select = " ".join(selects)
+    selects.append("order by {0}".format(order))
+    values = list(where_values) if where_values else []
+    if limit is not None:
+        selects.append("limit ?")
+        values.append(limit)
+        if offset is not None:
+            selects.append("offset ?")
+            values.append(offset)
+    selects.append(";")
+    return " ".join(selects), values
+
+
+def select_order(conn, table, columns, order, where_columns=None, where_values=None, limit=None, offset=None):
+    sql_select, values = order_sql(table, columns, order, where_columns, where_values, limit, offset)
     try:
         c = conn.cursor()
-        if where_values:
-            c.execute(sql_select, where_values)
+        if values:
+            c.execute(sql_select, values)
         else:
             c.execute(sql_select)
         result = c.fetchall()
@@ -280,6 +341,25 @@ def select_order(conn, table, columns, order, where_columns=None, where_values=N
         logger.info(sql_select)
 
 
+def explain_order(conn, table, columns, order, where_columns=None, where_values=None, limit=None, offset=None):
+    """ the query plan details of the select_order query """
+    sql_select, values = order_sql(table, columns, order, where_columns, where_values, limit, offset)
+    c = conn.cursor()
+    c.execute("explain query plan " + sql_select, values)
+    return [row[-1] for row in c.fetchall()]
+
+
+def nth_raid_query(guild_id, raid_number):
+    """ select_order arguments for the raid_number-th upcoming raid of a guild """
+    return 'Raids', ['raid_id', 'name', 'time'], 'time', ['guild_id'], [guild_id], 1, raid_number - 1
+
+
+def signed_up_query(player_id):
+    """ select_order arguments for the first 25 raids a player signed up for """
+    return 'Players join Raids using (raid_id)', ['raid_id', 'channel_id', 'guild_id', 'name', 'time'], 'time', \
+        ['player_id', 'unavailable'], [player_id, False], 25
+
+
 def select_le(conn, table, columns, where_columns=None, where_values=None):
     selects = ["select", ", ".join(columns), "from {0}".format(table)]
     if where_columns:
@@ -0,0 +1,284 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class DatabaseService:
+    """ owns the only writable connection to the database and serves the cluster workers over a unix socket """
+
+    def __init__(self, db_file, socket_path):
+        self.db_file = db_file
+        self.socket_path = socket_path
+        self.conn = sqlite3.connect(db_file)
+        # Workers read through their own read-only connections.
+        self.conn.execute("pragma journal_mode=wal;")
+        self.pending_commit = None
+        self.statement_count = 0
+        self.commit_count = 0
+
+    async def serve(self):
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        logger.info("Database service listening on {0}.".format(self.socket_path))
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            request = json.loads(line)
+            if request['op'] == 'execute':
+                # A worker reading its own uncommitted writes, they are rolled back again
+                response = {'results': self.execute_batch(request['statements'], keep=False)}
+            elif request['op'] == 'commit':
+                results = self.execute_batch(request['statements'], keep=True)
+                response = await self.commit()
+                response['results'] = results
+            else:
+                response = {'error': "Unknown operation {0}.".format(request['op'])}
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        writer.close()
+
+    def execute_batch(self, statements, keep):
+        """ execute the statements of one worker as a unit, no other worker's statements run in between
+
+        Only complete batches are left in the open transaction, so a commit never includes half of a worker's writes.
+        """
+        began = not self.conn.in_transaction
+        if began:
+            self.conn.execute("begin;")
+        self.conn.execute("savepoint batch;")
+        results = [self.execute(sql, params) for sql, params in statements]
+        if not keep:
+            self.conn.execute("rollback to batch;")
+        self.conn.execute("release batch;")
+        if began and not keep:
+            self.conn.rollback()
+        return results
+
+    def execute(self, sql, params):
+        self.statement_count += 1
+        try:
+            c = self.conn.cursor()
+            c.execute(sql, params)
+            return {'rowcount': c.rowcount, 'rows': c.fetchall()}
+        except sqlite3.Error as e:
+            return {'error': str(e)}
+
+    async def commit(self):
+        # Commit requests arriving in the same loop iteration share a single commit.
+        if self.pending_commit is None:
+            loop = asyncio.get_running_loop()
+            self.pending_commit = loop.create_future()
+            loop.call_soon(self.do_commit)
+        try:
+            await asyncio.shield(self.pending_commit)
+        except sqlite3.Error as e:
+            return {'error': str(e)}
+        return {'ok': True}
+
+    def do_commit(self):
+        future = self.pending_commit
+        self.pending_commit = None
+        self.commit_count += 1
+        try:
+            self.conn.commit()
+        except sqlite3.Error as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+
+
+class ConnectionLost(sqlite3.OperationalError):
+    """ the database service closed the connection or is gone """
+
+
+class ServiceCursor:
+    """ cursor of a ServiceConnection, mimics the parts of sqlite3.Cursor the database helpers use """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+        self.result = None
+
+    def execute(self, sql, parameters=()):
+        parameters = list(parameters)
+        self.rows = []
+        self.result = None
+        if not sql.lstrip().lower().startswith('select'):
+            # Writes are sent to the service on commit.
+            self.conn.pending.append((sql, parameters, self))
+        elif self.conn.pending:
+            # Uncommitted writes are only visible to the service.
+            self.conn.pending.append((sql, parameters, self))
+            self.conn.flush()
+        else:
+            self.conn.wait_for_commits()
+            cursor = self.conn.reader.execute(sql, parameters)
+            self.rows = cursor.fetchall()
+            self.result = {'rowcount': -1}
+        return self
+
+    def check_result(self):
+        if self.result is None:
+            self.conn.wait_for_commits()
+        if self.result is None:
+            self.conn.flush()
+        if 'error' in self.result:
+            raise sqlite3.OperationalError(self.result['error'])
+
+    @property
+    def rowcount(self):
+        self.check_result()
+        return self.result['rowcount']
+
+    def fetchall(self):
+        self.check_result()
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchone(self):
+        self.check_result()
+        if not self.rows:
+            return None
+        return self.rows.pop(0)
+
+
+class ServiceConnection:
+    """ sends writes to the database service and reads through a local read-only connection
+
+    Writes are kept until commit and then sent with it as one batch, which the service executes and commits without
+    interleaving other workers' writes. Commits are sent from a background thread, so they do not block the event loop.
+    Only a read that needs this worker's uncommitted or unacknowledged writes waits for the service.
+    """
+
+    def __init__(self, socket_path, db_file):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.stream = self.sock.makefile('rwb')
+        self.reader = sqlite3.connect("file:{0}?mode=ro".format(db_file), uri=True)
+        self.pending = []
+        # One request at a time on the socket, from either thread
+        self.lock = threading.Lock()
+        self.commits = queue.Queue()
+        self.unacknowledged = 0
+        self.acknowledged = threading.Condition()
+        self.sender = threading.Thread(target=self.send_commits, name="db-service-commits", daemon=True)
+        self.sender.start()
+
+    def request(self, request):
+        data = json.dumps(request).encode() + b"\n"
+        with self.lock:
+            try:
+                self.stream.write(data)
+                self.stream.flush()
+                line = self.stream.readline()
+            except OSError as e:
+                raise ConnectionLost("Lost connection to the database service: {0}".format(e))
+        if not line:
+            raise ConnectionLost("Lost connection to the database service.")
+        return json.loads(line)
+
+    def cursor(self):
+        return ServiceCursor(self)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    @staticmethod
+    def set_results(pending, results):
+        for (sql, params, cursor), result in zip(pending, results):
+            if cursor.result is not None:
+                continue
+            if 'error' in result:
+                logger.error("Database service failed to execute: {0}".format(sql))
+                logger.error(result['error'])
+            else:
+                cursor.rows = [tuple(row) for row in result['rows']]
+            cursor.result = result
+
+    def flush(self):
+        """ run the uncommitted statements on the service for their results, they stay pending until commit """
+        self.wait_for_commits()
+        if not self.pending:
+            return
+        response = self.request({'op': 'execute', 'statements': [[sql, params] for sql, params, cursor in self.pending]})
+        self.set_results(self.pending, response['results'])
+        self.pending = [statement for statement in self.pending if not statement[0].lstrip().lower().startswith('select')]
+
+    def commit(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        with self.acknowledged:
+            self.unacknowledged += 1
+        self.commits.put(pending)
+
+    def send_commits(self):
+        lost = False
+        while True:
+            pending = self.commits.get()
+            if pending is None:
+                return
+            try:
+                if lost:
+                    raise ConnectionLost("Lost connection to the database service.")
+                response = self.request({'op': 'commit', 'statements': [[sql, params] for sql, params, cursor in pending]})
+                self.set_results(pending, response.get('results', []))
+                if 'error' in response:
+                    logger.error("Database service failed to commit.")
+                    logger.error(response['error'])
+            except ConnectionLost as e:
+                if not lost:
+                    # Every later write would be dropped, stop the worker instead of running on without a database
+                    logger.critical(e)
+                    logger.critical("Stopping this worker.")
+                    lost = True
+                    os.kill(os.getpid(), signal.SIGTERM)
+            except Exception as e:
+                # Keep sending, a dead sender would leave wait_for_commits blocking forever
+                logger.exception(e)
+            finally:
+                for sql, params, cursor in pending:
+                    if cursor.result is None:
+                        cursor.result = {'error': "Commit failed."}
+                with self.acknowledged:
+                    self.unacknowledged -= 1
+                    self.acknowledged.notify_all()
+
+    def wait_for_commits(self):
+        """ block until the service has committed everything this connection sent """
+        with self.acknowledged:
+            self.acknowledged.wait_for(lambda: self.unacknowledged == 0)
+
+    def close(self):
+        self.commits.put(None)
+        self.sender.join()
+        self.stream.close()
+        self.sock.close()
+        self.reader.close()
+
+
+def connect_to_service(socket_path, db_file):
+    """ create a database connection through the database service """
+    conn = None
+    try:
+        conn = ServiceConnection(socket_path, db_file)
+    except (OSError, sqlite3.Error) as e:
+        logger.exception(e)
+    return conn
@@ -89,6 +89,23 @@ class DevCog(commands.Cog):
         embed = discord.Embed(title=title, colour=discord.Colour(0x3498db), description=content)
         await ctx.send(embed=embed)
 
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def shards(self, ctx):
+        """Shows gateway latency and background task durations per shard"""
+        lines = []
+        for shard_id, latency in self.bot.latencies:
+            guild_count = sum(1 for guild in self.bot.guilds if guild.shard_id == shard_id)
+            metrics = self.bot.shard_metrics[shard_id]
+            timings = ", ".join("{0}: {1:.0f} ms".format(name, duration * 1000) for name, duration in sorted(metrics.items()))
+            lines.append("**Shard {0}:** {1} guilds, latency {2:.0f} ms. {3}".format(shard_id, guild_count, latency * 1000, timings))
+        flight = self.bot.single_flight
+        lines.append("**HTTP:** {0} requests, {1} coalesced callers, {2} failures served from cache.".format(
+            flight.started, flight.coalesced, flight.negative_hits))
+        title = "Shard stats"
+        embed = discord.Embed(title=title, colour=discord.Colour(0x3498db), description="\n".join(lines))
+        await ctx.send(embed=embed)
+
     @commands.command(hidden=True)
     @commands.is_owner()
     async def list(self, ctx):
@@ -107,9 +124,13 @@ class DevCog(commands.Cog):
         active = 0
         inactive = 0
         deleted = 0
+        time_cog = self.bot.get_cog('TimeCog')
         for row in res:
             guild_id = row[0]
             last_command = row[1]
+            if not self.bot.is_local_guild(guild_id):
+                # Handled by another cluster worker.
+                continue
             guild = self.bot.get_guild(guild_id)
             if guild:
                 if last_command and last_command > cutoff_time:
@@ -122,6 +143,7 @@ class DevCog(commands.Cog):
             else:
                 logger.info("We are no longer in {0}".format(guild_id))
                 delete(self.conn, 'Settings', ['guild_id'], [guild_id])
+                time_cog.server_timezones.pop(guild_id)
                 deleted += 1
         self.conn.commit()
         logger.info("Active guild count: {0}".format(active))
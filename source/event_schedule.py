@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# Parses the lotro.com public event schedule.
+# Run this file with a saved copy of the page to check the parser without fetching it.
+
+import datetime
+import logging
+import lxml.html
+import pytz
+import re
+import sys
+import time
+
+from lxml import etree
+from typing import NamedTuple
+
+from time_parser import get_date_parsers
+from utils import chunks
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+event_url = "https://www.lotro.com/news/lotro-public-event-schedule-en"
+# Let us hope this questionable pattern is stable enough
+schedule_regex = re.compile(r'ALL TIMES EASTERN/SERVER TIME(.*)Ends \(Eastern Time\)(.*)Share On:', flags=re.DOTALL)
+eastern = pytz.timezone("America/New_York")
+# How the schedule usually writes times after clean_time, anything else goes to dateparser
+time_formats = ["%B %d, %Y at %I:%M %p", "%B %d, %Y %I:%M %p", "%A, %B %d, %Y at %I:%M %p", "%B %d, %Y"]
+
+
+class ScheduleRow(NamedTuple):
+    """ the cells of one row of the schedule table """
+    number: int
+    name: str
+    start: str
+    end: str
+
+
+def clean_time(time_string):
+    time_string = time_string.casefold()
+    time_string = time_string.replace(" eastern", "")
+    time_string = time_string.replace("approximately ", "")
+    return " ".join(time_string.split())
+
+
+def parse_event_time(time_string):
+    if not time_string:
+        return None
+    for time_format in time_formats:
+        try:
+            time = datetime.datetime.strptime(time_string, time_format)
+            break
+        except ValueError:
+            pass
+    else:
+        # lotro.com posts in English
+        time = get_date_parsers(['en']).parse_naive(time_string)
+    if time is None:
+        return None
+    if time.tzinfo is not None:
+        # The string named its own time zone, like est or edt
+        return int(time.timestamp())
+    return int(eastern.localize(time).timestamp())
+
+
+def parse_event_times(time_strings):
+    """ parse every distinct time string once
+
+    Returns a dict of string to timestamp and a dict of string to error message for the strings that raised.
+    """
+    times = {}
+    failures = {}
+    for time_string in set(time_strings):
+        if not time_string:
+            continue
+        try:
+            times[time_string] = parse_event_time(time_string)
+        except Exception as e:
+            # One odd string should not lose the rest of the schedule
+            times[time_string] = None
+            failures[time_string] = str(e)
+    return times, failures
+
+
+def find_schedule_table(text):
+    """ the table with the Ends (Eastern Time) column, None if the page has none
+
+    Only the markup of that table is parsed when it can be cut out of the page.
+    """
+    header = text.find('Ends (Eastern Time)')
+    if header < 0:
+        return None
+    start = text.rfind('<table', 0, header)
+    end = text.find('</table>', header)
+    if start >= 0 and end >= 0:
+        text = text[start:end + len('</table>')]
+    try:
+        document = lxml.html.fromstring(text)
+    except etree.ParserError:
+        return None
+    tables = [document] if document.tag == 'table' else document.iter('table')
+    for table in tables:
+        header = table.find('.//tr')
+        if header is not None and 'Ends (Eastern Time)' in header.text_content():
+            return table
+    return None
+
+
+def schedule_rows(table):
+    rows = []
+    for number, row in enumerate(table.iter('tr')):
+        cells = [" ".join(cell.text_content().split()) for cell in row if cell.tag in ('td', 'th')]
+        if number == 0 or not any(cells):
+            continue
+        cells += [''] * (3 - len(cells))
+        rows.append(ScheduleRow(number, *cells[:3]))
+    return rows
+
+
+def text_rows(text):
+    """ rows from the page text, for when the schedule is not a table """
+    stripped = re.sub('<[^<]+?>', '', text)
+    stripped = stripped.replace('\xa0', '')
+    stripped = stripped.replace('&gt;', '>')
+    result = schedule_regex.search(stripped)
+    if not result:
+        return None
+    events_data = [" ".join(line.split()) for line in result.group(2).strip().splitlines()] + ['']
+    return [ScheduleRow(number, *event[:3]) for number, event in enumerate(chunks(events_data, 5), 1) if len(event) >= 3]
+
+
+def failure_reason(failures, time_string):
+    reason = failures.get(clean_time(time_string))
+    return ": {0}".format(reason) if reason else ""
+
+
+def parse_rows(rows):
+    """ returns (events, errors), events are (name, start, end) tuples and errors (row number, message) tuples """
+    time_strings = (clean_time(time_string) for row in rows for time_string in (row.start, row.end))
+    times, failures = parse_event_times(time_strings)
+    events = []
+    errors = []
+    for row in rows:
+        if not row.name:
+            errors.append((row.number, "Event without a name."))
+            continue
+        start = times.get(clean_time(row.start))
+        end = times.get(clean_time(row.end))
+        if row.start and start is None:
+            errors.append((row.number, "Failed to parse start time {0!r} of {1}{2}.".format(
+                row.start, row.name, failure_reason(failures, row.start))))
+        if row.end and end is None:
+            errors.append((row.number, "Failed to parse end time {0!r} of {1}{2}.".format(
+                row.end, row.name, failure_reason(failures, row.end))))
+        if start and end and end < start:
+            errors.append((row.number, "{0} ends before it starts.".format(row.name)))
+            continue
+        events.append((row.name, start, end))
+    return events, errors
+
+
+def parse_schedule(text):
+    """ every (name, start, end) event on the schedule page and the rows that failed to parse
+
+    Returns None if the page layout is not recognised.
+    """
+    table = find_schedule_table(text)
+    if table is not None:
+        rows = schedule_rows(table)
+    else:
+        logger.warning("Event schedule table not found, falling back to the page text.")
+        rows = text_rows(text)
+        if rows is None:
+            return None
+    return parse_rows(rows)
+
+
+def upcoming_events(events, current_time):
+    """ events that are running or start within 60 days, events without an end are shown for 30 days """
+    cutoff_unlock = current_time - 30 * 86400
+    cutoff_past = current_time - 86400
+    cutoff_future = current_time + 60 * 86400
+
+    upcoming = []
+    for event in events:
+        start_time = current_time
+        if event[1]:
+            start_time = event[1]
+        if event[2]:
+            if cutoff_past < event[2] and start_time < cutoff_future:
+                upcoming.append(event)
+        else:
+            if cutoff_unlock < start_time < cutoff_future:
+                upcoming.append(event)
+        if start_time > cutoff_future:
+            break
+    return upcoming
+
+
+def benchmark_schedule(text, repeat=5):
+    """ time the table extractor against the page text extractor, returns (rows, table ms, text ms, identical) """
+    start = time.perf_counter()
+    for i in range(repeat):
+        table = find_schedule_table(text)
+        rows = schedule_rows(table) if table is not None else None
+    table_time = (time.perf_counter() - start) / repeat * 1000
+    start = time.perf_counter()
+    for i in range(repeat):
+        fallback = text_rows(text)
+    text_time = (time.perf_counter() - start) / repeat * 1000
+    identical = rows is not None and fallback is not None and \
+        [row[1:] for row in rows] == [row[1:] for row in fallback]
+    return len(rows or []), table_time, text_time, identical
+
+
+if __name__ == '__main__':
+    # Usage: event_schedule.py page.html [page.html ...]
+    logging.basicConfig(level=logging.INFO)
+    for file in sys.argv[1:]:
+        with open(file, encoding='utf-8') as f:
+            text = f.read()
+        print(file)
+        print("{0} rows, table {1:.2f} ms, text {2:.2f} ms, same rows: {3}".format(*benchmark_schedule(text)))
+        start = time.perf_counter()
+        result = parse_schedule(text)
+        print("Parsed in {0:.2f} ms.".format((time.perf_counter() - start) * 1000))
+        if result is None:
+            print("Schedule not found.")
+            continue
+        events, errors = result
+        for number, message in errors:
+            print("Row {0}: {1}".format(number, message))
+        for event in upcoming_events(events, time.time()):
+            print(event)
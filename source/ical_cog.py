@@ -0,0 +1,208 @@
+import discord
+import hashlib
+import hmac
+import logging
+import secrets
+import time
+
+from aiohttp import web
+from datetime import datetime, timezone
+from discord import app_commands
+from discord.ext import commands
+
+from database import select, select_in, select_order
+from utils import LRUCache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+raid_columns = ['raid_id', 'guild_id', 'channel_id', 'name', 'tier', 'boss', 'time']
+# Feeds rendered by another cluster worker's raids are only invalidated locally, expire them as well
+feed_ttl = 300
+
+
+def escape(text):
+    """ escape a TEXT value as RFC 5545 requires """
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def fold(line):
+    """ split a content line into lines of at most 75 octets """
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line
+    parts = []
+    while len(data) > 75:
+        cut = 75 if not parts else 74
+        # Do not split a multi-byte character
+        while cut and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+    parts.append(data.decode('utf-8'))
+    return "\r\n ".join(parts)
+
+
+def ical_time(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def render_event(raid):
+    raid_id, guild_id, channel_id, name, tier, boss, timestamp = raid
+    summary = " ".join([name, tier]) if tier else name
+    url = "https://discord.com/channels/{0}/{1}/{2}".format(guild_id, channel_id, raid_id)
+    lines = [
+        "BEGIN:VEVENT",
+        "UID:{0}@discord.com".format(raid_id),
+        "DTSTAMP:{0}".format(ical_time(time.time())),
+        "DTSTART:{0}".format(ical_time(timestamp)),
+        "DTEND:{0}".format(ical_time(timestamp + 7200)),
+        "SUMMARY:{0}".format(escape(summary)),
+        "URL:{0}".format(url),
+        "DESCRIPTION:{0}".format(escape("\n".join(filter(None, [boss, url])))),
+        "END:VEVENT",
+    ]
+    return "".join(fold(line) + "\r\n" for line in lines)
+
+
+class ICalCog(commands.Cog):
+    """ Serves the raids of a guild or of a user as iCalendar feeds for calendar apps """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.conn = bot.conn
+        self.port = int(bot.ical_port)
+        self.url = (bot.ical_url or "http://localhost:{0}".format(self.port)).rstrip("/")
+        secret = bot.ical_secret
+        if not secret:
+            logger.warning("No ICAL_SECRET configured, feed links will change when the bot restarts.")
+            secret = secrets.token_hex(32)
+        self.secret = secret.encode()
+        # (raid row, rendered VEVENT) per raid and (etag, body, rendered at) per feed
+        self.events = {}
+        self.feeds = LRUCache(10000)
+        # Who has a rendered feed containing a raid, to invalidate it when the raid changes
+        self.raid_guilds = {}
+        self.raid_users = {}
+        self.runner = None
+
+    async def cog_load(self):
+        # Every worker answers /ics, one serves the feeds of the whole cluster
+        if not self.bot.is_primary():
+            return
+        app = web.Application()
+        app.add_routes([web.get('/guild/{id}/{token}.ics', self.guild_feed),
+                        web.get('/user/{id}/{token}.ics', self.user_feed)])
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, port=self.port).start()
+        except OSError:
+            await runner.cleanup()
+            raise
+        self.runner = runner
+        logger.info("Serving calendar feeds on port {0}.".format(self.port))
+
+    async def cog_unload(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def token(self, kind, _id):
+        return hmac.new(self.secret, "{0}:{1}".format(kind, _id).encode(), hashlib.sha256).hexdigest()[:32]
+
+    def feed_url(self, kind, _id):
+        return "{0}/{1}/{2}/{3}.ics".format(self.url, kind, _id, self.token(kind, _id))
+
+    def invalidate(self, raid_ids):
+        """ drop the cached event of each raid and every cached feed containing it """
+        if self.runner is None:
+            # This worker does not serve the feeds
+            return
+        for raid_id in raid_ids:
+            self.events.pop(raid_id, None)
+            guild_id = self.raid_guilds.pop(raid_id, None)
+            if guild_id is not None:
+                self.feeds.pop(('guild', guild_id))
+            for user_id in self.raid_users.pop(raid_id, ()):
+                self.feeds.pop(('user', user_id))
+        # New raids and sign ups are not in a cached feed yet
+        for guild_id, in select_in(self.conn, 'Raids', ['guild_id'], 'raid_id', raid_ids):
+            self.feeds.pop(('guild', guild_id))
+        for user_id, in select_in(self.conn, 'Players', ['player_id'], 'raid_id', raid_ids):
+            self.feeds.pop(('user', user_id))
+
+    def render_feed(self, name, raids):
+        lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//Baviaan//LotRO raid bot//EN", "CALSCALE:GREGORIAN",
+                 "X-WR-CALNAME:{0}".format(escape(name))]
+        body = "".join(fold(line) + "\r\n" for line in lines)
+        for raid in raids:
+            # Raids edited through another cluster worker are not invalidated here, reuse events of unchanged rows only
+            cached = self.events.get(raid[0])
+            if cached is None or cached[0] != raid:
+                cached = (raid, render_event(raid))
+                self.events[raid[0]] = cached
+            body += cached[1]
+        body = (body + "END:VCALENDAR\r\n").encode('utf-8')
+        return hashlib.sha1(body).hexdigest(), body, time.time()
+
+    def get_feed(self, kind, _id):
+        key = (kind, _id)
+        feed = self.feeds.get(key)
+        if feed and feed[2] + feed_ttl > time.time():
+            return feed
+        if kind == 'guild':
+            raids = select_order(self.conn, 'Raids', raid_columns, 'time', ['guild_id'], [_id])
+            guild = self.bot.get_guild(_id)
+            name = _("{0} raids").format(guild.name) if guild else _("Raids")
+            for raid in raids:
+                self.raid_guilds[raid[0]] = _id
+        else:
+            raid_ids = [row[0] for row in select(self.conn, 'Players', ['raid_id'], ['player_id', 'unavailable'],
+                                                  [_id, False])]
+            raids = sorted(select_in(self.conn, 'Raids', raid_columns, 'raid_id', raid_ids), key=lambda raid: raid[6])
+            name = _("My raids")
+            for raid in raids:
+                self.raid_users.setdefault(raid[0], set()).add(_id)
+        feed = self.render_feed(name, raids)
+        self.feeds.put(key, feed)
+        return feed
+
+    def respond(self, request, kind):
+        try:
+            _id = int(request.match_info['id'])
+        except ValueError:
+            raise web.HTTPNotFound()
+        if not hmac.compare_digest(request.match_info['token'], self.token(kind, _id)):
+            raise web.HTTPNotFound()
+        etag, body, rendered_at = self.get_feed(kind, _id)
+        if request.if_none_match and any(tag.value == etag for tag in request.if_none_match):
+            response = web.Response(status=304)
+        else:
+            response = web.Response(body=body, content_type='text/calendar', charset='utf-8')
+        response.etag = etag
+        response.headers['Cache-Control'] = "max-age={0}".format(feed_ttl)
+        return response
+
+    async def guild_feed(self, request):
+        return self.respond(request, 'guild')
+
+    async def user_feed(self, request):
+        return self.respond(request, 'user')
+
+    @app_commands.command(name=_("ics"), description=_("Get links to subscribe to raids in your calendar app."))
+    @app_commands.guild_only()
+    async def ics_respond(self, interaction: discord.Interaction):
+        content = _("Add these links to your calendar app to subscribe to raids.\n"
+                    "**All raids in this server:** <{0}>\n"
+                    "**Raids you signed up for:** <{1}>").format(self.feed_url('guild', interaction.guild_id),
+                                                                 self.feed_url('user', interaction.user.id))
+        await interaction.response.send_message(content, ephemeral=True)
+
+
+async def setup(bot):
+    if not bot.ical_secret and not bot.is_primary():
+        # A random secret would differ from the one of the worker serving the feeds
+        logger.error("ICAL_SECRET is required in cluster mode, /ics is only available on the primary worker.")
+        return
+    await bot.add_cog(ICalCog(bot))
+    logger.info("Loaded ICal Cog.")
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# Compiles the lotro-data loot XML files into a sqlite index.
+# Run this file to build the index offline, the treasure cog rebuilds it on start up when it is out of date.
+
+import logging
+import os
+import psutil
+import re
+import sqlite3
+import xml.etree.ElementTree as ET
+
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import NamedTuple, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+containers_file = '../data/lore/containers.xml'
+loots_file = '../data/lore/loots.xml'
+index_file = 'loot_index.db'
+
+container_columns = ['id', 'name', 'filteredTrophyTableId', 'filteredTrophyTableId2', 'filteredTrophyTableId3',
+                     'trophyListId', 'barterTrophyListId', 'treasureListId', 'weightedTreasureTableId',
+                     'skirmishLootTableId']
+entry_columns = ['weight', 'minLevel', 'maxLevel', 'requiredClass', 'trophyListId', 'weightedTreasureTableId',
+                 'treasureGroupProfileId', 'treasureListId', 'itemId', 'name', 'quantity', 'dropFrequency']
+
+
+class Container(NamedTuple):
+    name: str
+    filteredTrophyTableIds: tuple
+    trophyListId: Optional[str]
+    barterTrophyListId: Optional[str]
+    treasureListId: Optional[str]
+    weightedTreasureTableId: Optional[str]
+    skirmishLootTableId: Optional[str]
+
+
+class ItemsTableEntry(NamedTuple):
+    weight: int
+    name: str
+    quantity: Optional[str]
+
+
+class FilteredTrophyTableEntry(NamedTuple):
+    minLevel: Optional[int]
+    maxLevel: Optional[int]
+    requiredClass: Optional[str]
+    trophyListId: Optional[str]
+    weightedTreasureTableId: Optional[str]
+
+
+class WeightedTreasureTableEntry(NamedTuple):
+    weight: int
+    trophyListId: str
+
+
+class TrophyListEntry(NamedTuple):
+    treasureGroupProfileId: Optional[str]
+    name: Optional[str]
+    quantity: Optional[str]
+    dropFrequency: float
+
+
+class TreasureListEntry(NamedTuple):
+    weight: Optional[int]
+    treasureGroupProfileId: str
+
+
+class SkirmishLootTableEntry(NamedTuple):
+    minLevel: Optional[int]
+    maxLevel: Optional[int]
+    requiredClass: Optional[str]
+    dropFrequency: float
+    trophyListId: Optional[str]
+    treasureGroupProfileId: Optional[str]
+
+
+class ItemDrop(NamedTuple):
+    """ a container that can drop an item, probability is None when the data does not say """
+    containerID: str
+    requiredClass: Optional[str]
+    minLevel: Optional[int]
+    maxLevel: Optional[int]
+    probability: Optional[float]
+
+
+class LootEntry(NamedTuple):
+    """ entry of any other kind of table """
+    weight: Optional[str]
+    minLevel: Optional[str]
+    maxLevel: Optional[str]
+    requiredClass: Optional[str]
+    trophyListId: Optional[str]
+    weightedTreasureTableId: Optional[str]
+    treasureGroupProfileId: Optional[str]
+    treasureListId: Optional[str]
+    itemId: Optional[str]
+    name: Optional[str]
+    quantity: Optional[str]
+    dropFrequency: Optional[str]
+
+
+def to_int(value):
+    if value is None:
+        return None
+    return int(value)
+
+
+entry_records = {
+    'itemsTable': lambda e: ItemsTableEntry(int(e.weight), e.name, e.quantity),
+    'filteredTrophyTable': lambda e: FilteredTrophyTableEntry(to_int(e.minLevel), to_int(e.maxLevel), e.requiredClass,
+                                                              e.trophyListId, e.weightedTreasureTableId),
+    'weightedTreasureTable': lambda e: WeightedTreasureTableEntry(int(e.weight), e.trophyListId),
+    'trophyList': lambda e: TrophyListEntry(e.treasureGroupProfileId, e.name, e.quantity, float(e.dropFrequency)),
+    'treasureList': lambda e: TreasureListEntry(to_int(e.weight), e.treasureGroupProfileId),
+    'skirmishLootTable': lambda e: SkirmishLootTableEntry(to_int(e.minLevel), to_int(e.maxLevel), e.requiredClass,
+                                                          float(e.dropFrequency or 1), e.trophyListId,
+                                                          e.treasureGroupProfileId),
+}
+
+
+class LootData:
+    """ the loot model as id-keyed maps of typed records """
+
+    def __init__(self, data_version):
+        self.data_version = data_version
+        self.containers = {}
+        self.tables = defaultdict(dict)
+        # Resolved sub-tables keyed on (kind, id), shared by every container referencing them
+        self.resolved = {}
+
+    @property
+    def itemsTables(self):
+        return self.tables['itemsTable']
+
+    @property
+    def filteredTrophyTables(self):
+        return self.tables['filteredTrophyTable']
+
+    @property
+    def weightedTreasureTables(self):
+        return self.tables['weightedTreasureTable']
+
+    @property
+    def trophyLists(self):
+        return self.tables['trophyList']
+
+    @property
+    def treasureLists(self):
+        return self.tables['treasureList']
+
+    @property
+    def skirmishLootTables(self):
+        return self.tables['skirmishLootTable']
+
+
+def load_loot_data(conn, data_version):
+    """ read the whole index into a LootData """
+    data = LootData(data_version)
+    for row in conn.execute("select {0} from Containers;".format(", ".join(container_columns))):
+        _id, name, filtered, filtered2, filtered3 = row[:5]
+        filteredTrophyTableIds = []
+        for filteredTrophyTableId in (filtered, filtered2, filtered3):
+            if filteredTrophyTableId is None:
+                break
+            filteredTrophyTableIds.append(filteredTrophyTableId)
+        data.containers[_id] = Container(name, tuple(filteredTrophyTableIds), *row[5:])
+    entries = defaultdict(list)
+    sql = "select kind, id, {0} from Entries order by kind, id, position;".format(", ".join(entry_columns))
+    for row in conn.execute(sql):
+        entries[row[0], row[1]].append(LootEntry(*row[2:]))
+    for kind, _id in conn.execute("select kind, id from Tables;"):
+        record = entry_records.get(kind, lambda e: e)
+        data.tables[kind][_id] = tuple(record(entry) for entry in entries[kind, _id])
+    return data
+
+
+def read_data_version():
+    with open('__init__.py') as f:
+        regex = r'^__lotro__\s*=\s*[\'"]([^\'"]*)[\'"]'
+        return re.search(regex, f.read(), re.MULTILINE).group(1)
+
+
+def data_signature(data_version):
+    """ the index is rebuilt whenever the data version or one of the XML files changes """
+    mtimes = [str(os.stat(file).st_mtime_ns) for file in (containers_file, loots_file)]
+    return ":".join([data_version] + mtimes)
+
+
+def memory_usage():
+    """ current and peak resident memory of this process """
+    rss = psutil.Process().memory_info().rss
+    usage = "{0:.1f} MB resident".format(rss / 1048576)
+    if resource:
+        # Linux reports the peak in kB
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage += " ({0:.1f} MB peak)".format(peak / 1024)
+    return usage
+
+
+def iter_elements(file):
+    """ stream the top level elements of an XML file, clearing each one after it has been processed """
+    context = ET.iterparse(file, events=('start', 'end'))
+    event, root = next(context)
+    depth = 0
+    for event, element in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            yield element
+            element.clear()
+            # Drop the processed element from the root as well
+            root.clear()
+
+
+def build_index(path=index_file, data_version=None):
+    """ parse the XML files and write them to a new index file """
+    if data_version is None:
+        data_version = read_data_version()
+    signature = data_signature(data_version)
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+    conn = sqlite3.connect(tmp_path)
+    c = conn.cursor()
+    c.execute("create table Meta (key text primary key, value text);")
+    c.execute("create table Containers ({0} text, primary key (id)) without rowid;".format(" text, ".join(container_columns)))
+    c.execute("create table Tables (kind text, id text, primary key (kind, id)) without rowid;")
+    c.execute("create table Entries (kind text, id text, position integer, {0} text, "
+              "primary key (kind, id, position)) without rowid;".format(" text, ".join(entry_columns)))
+
+    rss_before = memory_usage()
+    sql = "insert or replace into Containers values ({0});".format(", ".join("?" * len(container_columns)))
+    c.executemany(sql, ([child.attrib.get(column) for column in container_columns]
+                        for child in iter_elements(containers_file)))
+    sql = "insert or replace into Entries values ({0});".format(", ".join("?" * (len(entry_columns) + 3)))
+    for element in iter_elements(loots_file):
+        kind = element.tag
+        _id = element.attrib['id']
+        c.execute("insert or replace into Tables values (?, ?);", [kind, _id])
+        c.executemany(sql, ([kind, _id, position] + [entry.attrib.get(column) for column in entry_columns]
+                            for position, entry in enumerate(element)))
+    c.executemany("insert into Meta values (?, ?);", [('data_version', data_version), ('signature', signature)])
+    conn.commit()
+    conn.execute("vacuum;")
+    conn.close()
+    os.replace(tmp_path, path)
+    logger.info("Built loot index for data version {0}.".format(data_version))
+    logger.info("Memory usage before building the index: {0}, after: {1}.".format(rss_before, memory_usage()))
+
+
+def read_meta(path, key):
+    try:
+        conn = sqlite3.connect("file:{0}?mode=ro".format(path), uri=True)
+        try:
+            result = conn.execute("select value from Meta where key = ?;", [key]).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    if result:
+        return result[0]
+
+
+@contextmanager
+def index_lock(path):
+    """ hold an exclusive lock on the index, so cluster workers starting together build it only once """
+    with open(path + '.lock', 'w') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def open_index(path=index_file, data_version=None):
+    """ open the index read-only, rebuilding it first if it is out of date """
+    if data_version is None:
+        data_version = read_data_version()
+    signature = data_signature(data_version)
+    if read_meta(path, 'signature') != signature:
+        with index_lock(path):
+            # Another process may have rebuilt it while we waited for the lock
+            if read_meta(path, 'signature') != signature:
+                build_index(path, data_version)
+    return sqlite3.connect("file:{0}?mode=ro".format(path), uri=True, check_same_thread=False)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    with index_lock(index_file):
+        build_index()
@@ -0,0 +1,187 @@
+# Monte Carlo simulation of opening a container many times.
+# Uses NumPy when it is installed and falls back to the random module otherwise.
+
+import bisect
+import itertools
+import math
+import random
+
+from collections import Counter
+from typing import NamedTuple, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+percentiles = (50, 90, 99)
+# Without NumPy every opening is sampled in Python
+max_python_runs = 100000
+# Openings sampled at once by NumPy, bounds the memory of a simulation
+chunk_size = 100000
+
+
+class ItemStatistics(NamedTuple):
+    name: str
+    drops: int
+    chance: float
+    expected_runs: Optional[float]
+    percentiles: tuple
+
+
+class AliasTable:
+    """ Vose's alias method, samples a discrete distribution in constant time
+
+    The probabilities must add up to 1, they are not normalised.
+    """
+
+    def __init__(self, probabilities):
+        n = len(probabilities)
+        scaled = [p * n for p in probabilities]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+        if np is not None:
+            self.np_prob = np.array(self.prob)
+            self.np_alias = np.array(self.alias)
+
+    def sample(self, rng):
+        i = rng.randrange(len(self.prob))
+        if rng.random() < self.prob[i]:
+            return i
+        return self.alias[i]
+
+    def sample_array(self, rng, size):
+        i = rng.integers(len(self.prob), size=size)
+        return np.where(rng.random(size) < self.np_prob[i], i, self.np_alias[i])
+
+
+def prepare_rolls(rolls, index):
+    """ the chance, alias table and item ids of every roll, id -1 is the roll dropping nothing """
+    prepared = []
+    for chance, items in rolls:
+        if chance <= 0 or not items:
+            continue
+        probabilities = [probability for probability, name in items]
+        ids = [index[name] for probability, name in items]
+        # A weighted group can leave part of the roll to lists that are rolled separately
+        nothing = 1 - sum(probabilities)
+        if nothing > 1e-9:
+            probabilities.append(nothing)
+            ids.append(-1)
+        prepared.append((chance, AliasTable(probabilities), ids))
+    return prepared
+
+
+def count_keys(keys, counts):
+    """ the sorted distinct keys and the summed counts of each """
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts[order], starts)
+
+
+def simulate_numpy(prepared, count, runs, seed):
+    """ returns a histogram of the numbers of openings needed for each drop of each item
+
+    The openings are sampled in chunks, the last drop of every item is carried over to the next chunk.
+    Histograms are (gaps, drops) arrays sorted by gap.
+    """
+    rng = np.random.default_rng(seed)
+    prepared = [(chance, table, np.array(ids)) for chance, table, ids in prepared]
+    last = np.full(count, -1, dtype=np.int64)
+    keys = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    for start in range(0, runs if prepared else 0, chunk_size):
+        size = min(chunk_size, runs - start)
+        openings = []
+        items = []
+        for chance, table, ids in prepared:
+            if chance >= 1:
+                opened = np.arange(size)
+            else:
+                opened = np.flatnonzero(rng.random(size) < chance)
+            dropped = ids[table.sample_array(rng, len(opened))]
+            openings.append(opened[dropped >= 0])
+            items.append(dropped[dropped >= 0])
+        # One sort groups the drops by item and opening, duplicates are the same item dropping twice in one opening
+        chunk = np.sort(np.concatenate(items).astype(np.int64) * size + np.concatenate(openings))
+        if not len(chunk):
+            continue
+        chunk = chunk[np.concatenate(([True], chunk[1:] != chunk[:-1]))]
+        items, openings = np.divmod(chunk, size)
+        openings += start
+        # Openings needed for each drop, counted from the previous drop of the same item
+        gaps = np.diff(openings, prepend=-1)
+        firsts = np.flatnonzero(np.concatenate(([True], items[1:] != items[:-1])))
+        gaps[firsts] = openings[firsts] - last[items[firsts]]
+        lasts = np.append(firsts[1:], len(items)) - 1
+        last[items[lasts]] = openings[lasts]
+        keys, counts = count_keys(np.concatenate((keys, items * (runs + 1) + gaps)),
+                                  np.concatenate((counts, np.ones(len(gaps), dtype=np.int64))))
+    items, gaps = np.divmod(keys, runs + 1)
+    bounds = np.searchsorted(items, np.arange(count + 1))
+    return [(gaps[bounds[i]:bounds[i + 1]], counts[bounds[i]:bounds[i + 1]]) for i in range(count)]
+
+
+def simulate_python(prepared, count, runs, seed):
+    """ returns a histogram of the numbers of openings needed for each drop of each item """
+    rng = random.Random(seed)
+    drops = [[] for i in range(count)]
+    for opening in range(runs):
+        for chance, table, ids in prepared:
+            if chance >= 1 or rng.random() < chance:
+                item = ids[table.sample(rng)]
+                if item < 0:
+                    continue
+                dropped = drops[item]
+                # Several rolls can drop the same item in one opening
+                if not dropped or dropped[-1] != opening:
+                    dropped.append(opening)
+    histograms = []
+    for openings in drops:
+        # Openings needed for each drop, counted from the previous drop of the same item
+        gaps = Counter(b - a for a, b in zip([-1] + openings[:-1], openings))
+        histograms.append((sorted(gaps), [gaps[gap] for gap in sorted(gaps)]))
+    return histograms
+
+
+def statistics(name, histogram, runs):
+    gaps, counts = histogram
+    cumulative = list(itertools.accumulate(int(count) for count in counts))
+    drops = cumulative[-1] if cumulative else 0
+    if not drops:
+        return ItemStatistics(name, 0, 0.0, None, (None,) * len(percentiles))
+    total = sum(int(gap) * int(count) for gap, count in zip(gaps, counts))
+    values = tuple(int(gaps[bisect.bisect_right(cumulative, max(math.ceil(q / 100 * drops) - 1, 0))])
+                   for q in percentiles)
+    return ItemStatistics(name, drops, drops / runs, total / drops, values)
+
+
+def simulate(rolls, runs, seed=None):
+    """ open a container runs times and return the statistics of every item it can drop, most common first
+
+    rolls is a list of independent (chance, [(probability, name)]) rolls made for every opening
+    """
+    names = sorted({name for chance, items in rolls for probability, name in items})
+    index = {name: i for i, name in enumerate(names)}
+    prepared = prepare_rolls(rolls, index)
+    if np is not None:
+        histograms = simulate_numpy(prepared, len(names), runs, seed)
+    else:
+        runs = min(runs, max_python_runs)
+        histograms = simulate_python(prepared, len(names), runs, seed)
+    results = [statistics(name, histogram, runs) for name, histogram in zip(names, histograms)]
+    results.sort(key=lambda result: -result.chance)
+    return runs, results
@@ -14,7 +14,8 @@ import re
 import time
 from typing import Optional
 
-from database import create_table, count, delete, read_config_key, select, select_le, select_one, select_order, upsert
+from database import create_table, count, delete, delete_in, nth_raid_query, read_config_key, select, select_in, \
+    select_le, select_one, select_order, signed_up_query, upsert
 from time_cog import Time
 from utils import get_match
 
@@ -33,6 +34,9 @@ Classes = Enum("Classes", role_names)
 
 sign_up_delay = 3
 assign_delay = 10
+expiry_time = 7200  # Delete raids after 2 hours.
+notify_time = 300  # Notify raiders 5 minutes before.
+
 
 class RaidCog(commands.Cog):
 
@@ -58,12 +62,17 @@ class RaidCog(commands.Cog):
         create_table(self.conn, 'player')
         create_table(self.conn, 'assign')
         create_table(self.conn, 'specs')
+        create_table(self.conn, 'raid_time_index')
+        create_table(self.conn, 'raid_guild_index')
+        create_table(self.conn, 'player_index')
 
         raids = select(self.conn, 'Raids', ['raid_id'])
-        self.raids = [raid[0] for raid in raids]
+        self.raids = {raid[0] for raid in raids}
         logger.info("We have loaded {} raids in memory.".format(len(self.raids)))
 
         self.update_call = {}
+        # Raids whose guild event changed, sent along with the next raid post update
+        self.event_edits = set()
 
         # Emojis
         host_guild = bot.get_guild(bot.host_id)
@@ -246,14 +255,15 @@ class RaidCog(commands.Cog):
             await interaction.response.send_message(_("You must be a raid leader to list players."))
             return
         conn = self.conn
-        raids = select_order(conn, 'Raids', ['raid_id', 'name', 'time'], 'time', ['guild_id'], [interaction.guild_id])
-        if raid_number > len(raids):
-            await interaction.response.send_message(_("Cannot list raid {0}: only {1} raids exist.").format(raid_number, len(raids)))
-            return
-        elif raid_number < 1:
+        if raid_number < 1:
             await interaction.response.send_message(_("Please provide a positive integer."))
             return
-        raid_id, raid_name, raid_time = raids[raid_number-1]
+        raid = select_order(conn, *nth_raid_query(interaction.guild_id, raid_number))
+        if not raid:
+            number_of_raids = count(conn, 'Raids', 'raid_id', ['guild_id'], [interaction.guild_id])
+            await interaction.response.send_message(_("Cannot list raid {0}: only {1} raids exist.").format(raid_number, number_of_raids))
+            return
+        raid_id, raid_name, raid_time = raid[0]
         player_data = select_order(conn, 'Players', ['byname', 'timestamp'], 'timestamp', ['raid_id', 'unavailable'], [raid_id, False])
 
         # build the embed
@@ -290,16 +300,11 @@ class RaidCog(commands.Cog):
 
     @app_commands.command(name=_("list_raids"), description=_("Lists the events you have signed up for."))
     async def list_raids_respond(self, interaction: discord.Interaction):
-        raids = select(self.conn, 'Players', ['raid_id'], ['player_id', 'unavailable'], [interaction.user.id, False])
-        for i, raid in enumerate(raids):
-            raid_data = select_one(self.conn, 'Raids', ['channel_id', 'guild_id', 'name', 'time'], ['raid_id'], [raid[0]])
-            raids[i] = raid + raid_data
-        # sort by raid time instead of creation time
-        raids.sort(key=lambda x: int(x[4]))
+        raids = select_order(self.conn, *signed_up_query(interaction.user.id))
         # build the embed
         embed_title = _("**You are signed up for the following events:**")
         embed = discord.Embed(title=embed_title, colour=discord.Colour(0x3498db))
-        for raid in raids[:25]:
+        for raid in raids:
             raid_id, channel_id, guild_id, name, time = raid
             field_name = f"{name} at <t:{time}>"
             field_text = f"https://discord.com/channels/{guild_id}/{channel_id}/{raid_id}"
@@ -357,10 +362,11 @@ class RaidCog(commands.Cog):
         else:
             embed = self.build_raid_message(raid_id, "\u200B", None)
             await post.edit(embed=embed, view=CreepView(self))
-        self.raids.append(raid_id)
+        self.raids.add(raid_id)
         await self.create_guild_event(channel, raid_id)
         self.conn.commit()
         logger.info("Created new raid: {0} at {1} for guild {2}.".format(full_name, raid_time, guild_id))
+        self.invalidate_feeds([raid_id])
         await self.calendar_cog.update_calendar(guild_id)
 
     async def create_guild_event(self, channel, raid_id):
@@ -399,6 +405,11 @@ class RaidCog(commands.Cog):
             await channel.send(perm_msg, delete_after=15)
         return False
 
+    def invalidate_feeds(self, raid_ids):
+        ical_cog = self.bot.get_cog('ICalCog')
+        if ical_cog:
+            ical_cog.invalidate(raid_ids)
+
     async def update_raid_post(self, raid_id, channel, delay=assign_delay):
         try:
             self.update_call[raid_id] += 1
@@ -409,6 +420,7 @@ class RaidCog(commands.Cog):
         # If someone is spamming buttons only send the last update
         if update_call < self.update_call[raid_id]:
             return
+        self.invalidate_feeds([raid_id])
         available = self.build_raid_players(raid_id)
         unavailable = self.build_raid_players(raid_id, available=False)
         embed = self.build_raid_message(raid_id, available, unavailable)
@@ -428,6 +440,10 @@ class RaidCog(commands.Cog):
             error_msg = "\n".join([msg, embed.title, embed.description, str(embed.fields)])
             logger.warning(error_msg)
             await channel.send(_("That's an error. Check the logs."))
+        # After the post, so a failing event edit cannot hold up the raid post
+        if raid_id in self.event_edits:
+            self.event_edits.discard(raid_id)
+            await self.calendar_cog.modify_guild_event(channel.guild, raid_id)
 
     def build_raid_message(self, raid_id, embed_texts_av, embed_texts_unav):
         try:
@@ -597,13 +613,40 @@ class RaidCog(commands.Cog):
 
     @tasks.loop(seconds=300)
     async def background_task(self):
-        bot = self.bot
-        expiry_time = 7200  # Delete raids after 2 hours.
-        notify_time = 300  # Notify raiders 5 minutes before.
         current_time = datetime.datetime.now().timestamp()
-
+        expired_raids = select_le(self.conn, 'Raids', ['raid_id', 'channel_id', 'guild_id'], ['time'],
+                                  [current_time - expiry_time])
         cutoff = current_time + notify_time + 1
-        raids = select_le(self.conn, 'Raids', ['raid_id', 'channel_id', 'time', 'roster'], ['time'], [cutoff])
+        raids = select_le(self.conn, 'Raids', ['raid_id', 'channel_id', 'guild_id', 'time', 'roster'], ['time'], [cutoff])
+        # Each shard only handles the raids of its own guilds.
+        expired_raids = self.bot.partition_by_shard(expired_raids, 2)
+        raids = self.bot.partition_by_shard(raids, 2)
+        await asyncio.gather(*[self.shard_background_task(shard_id, expired_raids[shard_id], raids[shard_id], current_time)
+                               for shard_id in raids])
+        logger.debug("Completed raid background task.")
+
+    async def shard_background_task(self, shard_id, expired_raids, raids, current_time):
+        start = time.perf_counter()
+        bot = self.bot
+
+        # Sweep all expired raids at once.
+        expired = []
+        for raid in expired_raids:
+            raid_id = int(raid[0])
+            channel = bot.get_channel(int(raid[1]))
+            if channel:
+                post = channel.get_partial_message(raid_id)
+                try:
+                    await post.delete()
+                except (discord.NotFound, discord.Forbidden):
+                    pass
+                except discord.DiscordServerError:
+                    # Retry during the next sweep.
+                    logger.warning("Discord server error when deleting the raid message.")
+                    continue
+            expired.append(raid_id)
+        await self.cleanup_old_raids(expired, "Deleted {0} expired raid posts.".format(len(expired)))
+
         raid_start_msgs = [
             _("Gondor calls for aid! {} will you answer?"),
             _("It's a dangerous business, {}, going out your door."),
@@ -614,28 +657,32 @@ class RaidCog(commands.Cog):
             _("I can't carry it for you, but I can carry you {}."),
             _("Looks like raiding's back on the menu, {}."),
         ]
+        stale = []
         for raid in raids:
             raid_id = int(raid[0])
             channel_id = int(raid[1])
-            timestamp = int(raid[2])
-            roster = int(raid[3])
+            timestamp = int(raid[3])
+            roster = int(raid[4])
+            if current_time > timestamp + expiry_time:
+                # Left over from a failed deletion in the sweep above.
+                continue
             channel = bot.get_channel(channel_id)
             if not channel:
-                await self.cleanup_old_raid(raid_id, "Raid channel has been deleted.")
+                logger.info("Raid channel has been deleted.")
+                stale.append(raid_id)
                 continue
             try:
                 post = await channel.fetch_message(raid_id)
             except discord.NotFound:
-                await self.cleanup_old_raid(raid_id, "Raid post already deleted.")
+                logger.info("Raid post already deleted.")
+                stale.append(raid_id)
             except discord.Forbidden:
-                await self.cleanup_old_raid(raid_id, "We are missing required permissions to see raid post.")
+                logger.info("We are missing required permissions to see raid post.")
+                stale.append(raid_id)
             except discord.DiscordServerError:
                 logger.warning("Discord server error when fetching the raid message.")
             else:
-                if current_time > timestamp + expiry_time:
-                    await self.cleanup_old_raid(raid_id, "Deleted expired raid post.")
-                    await post.delete()
-                elif current_time < timestamp:
+                if current_time < timestamp:
                     raid_start_msg = random.choice(raid_start_msgs)
                     players = select(self.conn, 'Assignment', ['player_id'], ['raid_id'], [raid_id])
                     player_ids = ["<@{}>".format(player[0]) for player in players if player[0]]
@@ -649,31 +696,43 @@ class RaidCog(commands.Cog):
                         await channel.send(raid_start_msg, delete_after=notify_time * 2)
                     except discord.Forbidden:
                         logger.warning("Missing permissions to send raid notification to channel {0}".format(channel.id))
+        await self.cleanup_old_raids(stale, "Deleted {0} stale raids.".format(len(stale)))
 
         self.conn.commit()
-        logger.debug("Completed raid background task.")
+        bot.record_shard_metric(shard_id, 'raid_task', time.perf_counter() - start)
 
     async def cleanup_old_raid(self, raid_id, message):
+        await self.cleanup_old_raids([raid_id], message)
+
+    async def cleanup_old_raids(self, raid_ids, message):
+        if not raid_ids:
+            return
         logger.info(message)
-        tag, guild_id = select_one(self.conn, 'Raids', ['tag', 'guild_id'], ['raid_id'], [raid_id])
-        guild = self.bot.get_guild(guild_id)
-        if guild:
-            role = discord.utils.get(guild.roles, name=tag)
-            if role:
-                await role.delete()
-        delete(self.conn, 'Raids', ['raid_id'], [raid_id])
-        delete(self.conn, 'Players', ['raid_id'], [raid_id])
-        delete(self.conn, 'Assignment', ['raid_id'], [raid_id])
-        logger.info("Deleted old raid from database.")
-        await self.calendar_cog.update_calendar(guild_id)
-        try:
-            self.raids.remove(raid_id)
-        except ValueError:
-            logger.info("Raid already deleted from memory.")
-        try:
-            del self.update_call[raid_id]
-        except KeyError:
-            logger.info("Raid cache already deleted from memory.")
+        raids = select_in(self.conn, 'Raids', ['tag', 'guild_id'], 'raid_id', raid_ids)
+        guild_ids = set()
+        for tag, guild_id in raids:
+            guild_ids.add(guild_id)
+            guild = self.bot.get_guild(guild_id)
+            if guild:
+                role = discord.utils.get(guild.roles, name=tag)
+                if role:
+                    try:
+                        await role.delete()
+                    except discord.HTTPException:
+                        logger.warning("Failed to delete raid role {0} in guild {1}.".format(tag, guild_id))
+        delete_in(self.conn, 'Raids', 'raid_id', raid_ids)
+        delete_in(self.conn, 'Players', 'raid_id', raid_ids)
+        delete_in(self.conn, 'Assignment', 'raid_id', raid_ids)
+        self.conn.commit()
+        logger.info("Deleted {0} old raids from database.".format(len(raid_ids)))
+        self.invalidate_feeds(raid_ids)
+        # Refresh each affected calendar once.
+        for guild_id in guild_ids:
+            await self.calendar_cog.update_calendar(guild_id)
+        self.raids.difference_update(raid_ids)
+        for raid_id in raid_ids:
+            self.update_call.pop(raid_id, None)
+            self.event_edits.discard(raid_id)
 
     @background_task.before_loop
     async def before_background_task(self):
@@ -1134,10 +1193,10 @@ class ConfigureModal(discord.ui.Modal):
         self.conn.commit()
         # respond
         await interaction.response.send_message(resp_msg, ephemeral=True, delete_after=assign_delay)
-        # Update corresponding discord posts and events
+        # Update corresponding discord posts and events, the guild event is edited with the debounced raid post
+        self.raid_cog.event_edits.add(self.raid_id)
         await self.raid_cog.update_raid_post(self.raid_id, interaction.channel)
         await self.calendar_cog.update_calendar(interaction.guild.id)
-        await self.calendar_cog.modify_guild_event(interaction.guild, self.raid_id)
         self.stop()
 
     async def delete_raid(self, interaction: discord.Interaction):
@@ -1,8 +1,10 @@
+import asyncio
 import discord
 import feedparser
 import json
 import logging
 import ssl
+import time
 
 from bs4 import BeautifulSoup
 from discord import app_commands
@@ -14,6 +16,9 @@ from database import create_table, select, select_one, upsert
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Feeds fetched at the same time
+rss_concurrency = 3
+
 
 @app_commands.guild_only()
 class RSSCog(commands.GroupCog, name=_("rss"), description=_("Manage RSS settings.")):
@@ -22,31 +27,56 @@ class RSSCog(commands.GroupCog, name=_("rss"), description=_("Manage RSS setting
         self.bot = bot
         self.conn = bot.conn
         create_table(self.conn, 'rss')
+        # Loading the certificate chain is slow, it is loaded once on the first fetch
+        self.ssl_context = None
+        self.fetch_semaphore = asyncio.Semaphore(rss_concurrency)
+        # ETag and Last-Modified of each feed
+        self.validators = {}
         super().__init__()
 
     async def cog_load(self):
-        self.rss_task.start()
+        # In cluster mode a single worker posts to every guild.
+        if self.bot.is_primary():
+            self.rss_task.start()
 
     async def cog_unload(self):
         self.rss_task.cancel()
 
     async def get_rss_feed(self, url):
-        ssl_context = ssl.create_default_context(cafile="../lotro-com-chain.pem")
-        async with self.bot.http_session.get(url, ssl=ssl_context) as resp:
-            text = await resp.text()
-            if not resp.ok:
-                logger.error("LotRO forums endpoint status: {0}.".format(resp.status))
-                logger.error(text)
-                return None
+        """ the parsed feed and its validators, None if it did not change since the last fetch or could not be fetched """
+        headers = {}
+        etag, last_modified = self.validators.get(url, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        if self.ssl_context is None:
+            self.ssl_context = ssl.create_default_context(cafile="../lotro-com-chain.pem")
+        async with self.fetch_semaphore:
+            async with self.bot.http_session.get(url, ssl=self.ssl_context, headers=headers) as resp:
+                if resp.status == 304:
+                    return None
+                text = await resp.text()
+                if not resp.ok:
+                    logger.error("LotRO forums endpoint status: {0}.".format(resp.status))
+                    logger.error(text)
+                    return None
+                validators = (resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
         feed = feedparser.parse(text)
-        return feed
+        return feed, validators
 
     async def get_new_posts(self, urls):
-        for thread_id, url in urls.items():
-            last_post_id = select_one(self.conn, 'RSS', ['post_id'], ['thread_id'], [thread_id])
-            feed = await self.get_rss_feed(url)
-            if not feed:
+        # A feed that fails to fetch should not keep the other feeds from being posted
+        feeds = await asyncio.gather(*[self.get_rss_feed(url) for url in urls.values()], return_exceptions=True)
+        for (thread_id, url), result in zip(urls.items(), feeds):
+            if isinstance(result, Exception):
+                logger.warning("Failed to fetch RSS feed {0}.".format(url))
+                logger.warning(result)
+                continue
+            if not result:
                 continue
+            feed, validators = result
+            last_post_id = select_one(self.conn, 'RSS', ['post_id'], ['thread_id'], [thread_id])
             if not last_post_id:
                 last_post_id = 0
             entries = sorted(feed.entries, key=lambda d: d['id'])
@@ -58,24 +88,37 @@ class RSSCog(commands.GroupCog, name=_("rss"), description=_("Manage RSS setting
                     upsert(self.conn, 'RSS', ['post_id'], [post_id], ['thread_id'], [thread_id])
                     await self.post_to_servers(entry)
             self.conn.commit()
+            # Only skip the feed once its posts have been handled
+            self.validators[url] = validators
 
     async def post_to_servers(self, entry):
         content = BeautifulSoup(entry.content[0].value, 'lxml')
         text = content.get_text() + "\n" + entry.link
         embed = discord.Embed(title=entry.title, colour=discord.Colour(0x3498db), description=text)
         res = select(self.conn, 'Settings', ['guild_id', 'rss'])
-        for row in res:
-            if row[1]:
-                await self.post_embed(*row, embed)
+        partitions = self.bot.partition_by_shard([row for row in res if row[1]], local_only=False)
+        await asyncio.gather(*[self.post_to_shard(shard_id, rows, embed) for shard_id, rows in partitions.items()])
+
+    async def post_to_shard(self, shard_id, rows, embed):
+        start = time.perf_counter()
+        for row in rows:
+            await self.post_embed(*row, embed)
+        self.bot.record_shard_metric(shard_id, 'rss_task', time.perf_counter() - start)
 
     async def post_embed(self, guild_id, chn_id, embed):
         chn = self.bot.get_channel(chn_id)
+        if not chn and not self.bot.is_local_guild(guild_id):
+            # The guild is handled by another cluster worker.
+            chn = self.bot.get_partial_messageable(chn_id, guild_id=guild_id)
         if chn:
             try:
                 await chn.send(embed=embed)
             except discord.Forbidden:
                 logger.warning("Missing write access to RSS channel for guild {0}.".format(guild_id))
                 upsert(self.conn, 'Settings', ['rss'], [None], ['guild_id'], [guild_id])
+            except discord.NotFound:
+                logger.warning("RSS channel not found for guild {0}.".format(guild_id))
+                upsert(self.conn, 'Settings', ['rss'], [None], ['guild_id'], [guild_id])
 
         else:
             logger.warning("RSS channel not found for guild {0}.".format(guild_id))
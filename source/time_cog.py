@@ -1,15 +1,17 @@
-import dateparser
 import datetime
 import discord
 import logging
 import pytz
+import time
 
 from discord import app_commands
 from discord.ext import commands
 from typing import Optional
 
 from database import create_table, select_one, upsert
-from utils import get_partial_matches
+from time_parser import parse_time
+from timezone_index import TimeZoneIndex
+from utils import LRUCache
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -20,15 +22,14 @@ with open('common_timezones.txt', 'r') as f:
 with open('timezones.txt', 'r') as f:
     timezones = f.read().splitlines()
 
+timezone_index = TimeZoneIndex(timezones, common_timezones)
+# Seconds a user's time zone is cached, in cluster mode it can be changed through another worker
+user_timezone_ttl = 300
+
 async def time_zone_autocomplete(interaction: discord.Interaction, current: str):
-    tz_suggestions = common_timezones
-    if current:
-        query = get_partial_matches(current, timezones)
-        if query:
-            tz_suggestions = query
     return [
         app_commands.Choice(name=tz, value=tz)
-        for tz in tz_suggestions
+        for tz in timezone_index.search(current)
     ]
 
 
@@ -45,28 +46,17 @@ class Time(commands.Converter):
     @staticmethod
     def converter(bot, guild_id, author_id, argument):
         time_cog = bot.get_cog('TimeCog')
-        parse_settings = {'PREFER_DATES_FROM': 'future'}
         argument_lower = argument.lower()
         server = _("server")
         if server in argument_lower:
             # Strip off server (time) and return as server time
             argument = argument_lower.partition(server)[0]
-            parse_settings['TIMEZONE'] = time_cog.get_server_timezone(guild_id)
-            parse_settings['RETURN_AS_TIMEZONE_AWARE'] = True
-        time = dateparser.parse(argument, settings=parse_settings)
+            tz_name = time_cog.get_server_timezone(guild_id)
+        else:
+            tz_name = time_cog.get_user_timezone(author_id, guild_id)
+        time = parse_time(argument, tz_name, languages=bot.languages)
         if time is None:
             raise commands.BadArgument(_("Failed to parse time argument: ") + argument)
-        if time.tzinfo is None:
-            user_timezone = time_cog.get_user_timezone(author_id, guild_id)
-            parse_settings['TIMEZONE'] = user_timezone
-            parse_settings['RETURN_AS_TIMEZONE_AWARE'] = True
-            tz = pytz.timezone(parse_settings['TIMEZONE'])
-        else:
-            tz = time.tzinfo
-        # Parse again with time zone specific relative base as workaround for upstream issue
-        # Upstream always checks if the time has passed in UTC, not in the specified timezone
-        parse_settings['RELATIVE_BASE'] = datetime.datetime.now(tz=tz).replace(tzinfo=None)
-        time = dateparser.parse(argument, settings=parse_settings)
 
         timestamp = int(time.timestamp())
         # Avoid scheduling event in the past
@@ -80,26 +70,40 @@ class TimeCog(commands.Cog):
         self.bot = bot
         self.conn = bot.conn
         create_table(self.bot.conn, 'timezone')
+        # Resolved time zones, users map to (time zone, expiry) with None for users without a personal time zone
+        self.user_timezones = LRUCache(10000)
+        self.server_timezones = LRUCache(2000)
+
+    def get_user_tzinfo(self, user_id, guild_id):
+        tz, expires = self.user_timezones.get(user_id, (None, 0))
+        if expires < time.monotonic():
+            result = select_one(self.conn, 'Timezone', ['timezone'], ['player_id'], [user_id])
+            tz = pytz.timezone(result) if result else None
+            self.user_timezones.put(user_id, (tz, time.monotonic() + user_timezone_ttl))
+        if tz is None:
+            tz = self.get_server_tzinfo(guild_id)
+        return tz
+
+    def get_server_tzinfo(self, guild_id):
+        tz = self.server_timezones.get(guild_id)
+        if tz is None:
+            result = select_one(self.conn, 'Settings', ['server'], ['guild_id'], [guild_id])
+            if result is None:
+                result = self.bot.server_tz
+            tz = pytz.timezone(result)
+            self.server_timezones.put(guild_id, tz)
+        return tz
 
     def get_user_timezone(self, user_id, guild_id):
-        conn = self.bot.conn
-        result = select_one(conn, 'Timezone', ['timezone'], ['player_id'], [user_id])
-        if result is None:
-            result = self.get_server_timezone(guild_id)
-        return result
+        return self.get_user_tzinfo(user_id, guild_id).zone
 
     def get_server_timezone(self, guild_id):
-        conn = self.bot.conn
-        result = select_one(conn, 'Settings', ['server'], ['guild_id'], [guild_id])
-        if result is None:
-            result = self.bot.server_tz
-        return result
+        return self.get_server_tzinfo(guild_id).zone
 
     @app_commands.command(name=_("server_time"), description=_("Shows the current server time."))
     @app_commands.guild_only()
     async def server_time_respond(self, interaction: discord.Interaction):
-        tz_str = self.get_server_timezone(interaction.guild_id)
-        server_tz = pytz.timezone(tz_str)
+        server_tz = self.get_server_tzinfo(interaction.guild_id)
         server_time = datetime.datetime.now(tz=server_tz)
 
         formatted_time = server_time.strftime("%A %H:%M")
@@ -126,6 +130,7 @@ class TimeCog(commands.Cog):
             content = _("Deleted your time zone data.")
         res = upsert(self.conn, 'Timezone', ['timezone'], [tz], ['player_id'], [interaction.user.id])
         self.conn.commit()
+        self.user_timezones.pop(interaction.user.id)
         await interaction.response.send_message(content, ephemeral=True)
 
     @group.command(name=_("server"), description=_("Set the time zone for this discord server."))
@@ -149,6 +154,7 @@ class TimeCog(commands.Cog):
             content = _("Deleted server time zone data.")
         res = upsert(self.conn, 'Settings', ['server'], [tz], ['guild_id'], [interaction.guild_id])
         self.conn.commit()
+        self.server_timezones.pop(interaction.guild_id)
         await interaction.response.send_message(content, ephemeral=True)
 
 
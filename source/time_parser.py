@@ -0,0 +1,256 @@
+import dateparser
+import datetime
+import re
+import time
+
+import pytz
+
+from dateparser.date import DateDataParser
+
+from utils import LRUCache
+
+weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+months = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october',
+          'november', 'december']
+numbers = {'a': 1, 'an': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8,
+           'nine': 9, 'ten': 10, 'eleven': 11, 'twelve': 12}
+units = {'minute': datetime.timedelta(minutes=1), 'hour': datetime.timedelta(hours=1),
+         'day': datetime.timedelta(days=1), 'week': datetime.timedelta(weeks=1)}
+
+weekday_pattern = r'(?P<weekday>{0})'.format('|'.join(day + '|' + day[:3] for day in weekdays))
+month_pattern = r'(?P<month>{0})'.format('|'.join(month + '|' + month[:3] for month in months))
+day_pattern = r'(?P<day>\d{1,2})'
+clock_pattern = r'(?P<hour>\d{1,2})(?::(?P<minute>\d{2}))?\s*(?P<ampm>am|pm)|(?P<hour24>\d{1,2}):(?P<minute24>\d{2})'
+
+# The formats taught in the welcome message, anything else goes to dateparser
+relative_regex = re.compile(r'in (?P<amount>\d+|{0}) (?P<unit>{1})s?'.format('|'.join(numbers), '|'.join(units)))
+weekday_regex = re.compile(r'{0}(?: (?:{1}))?'.format(weekday_pattern, clock_pattern))
+date_regexes = [re.compile(r'{0} {1}(?: (?:{2}))?'.format(day_pattern, month_pattern, clock_pattern)),
+                re.compile(r'{1} {0}(?: (?:{2}))?'.format(day_pattern, month_pattern, clock_pattern))]
+day_regex = re.compile(r'(?P<relative>today|tomorrow)(?: (?:{0}))?'.format(clock_pattern))
+clock_regex = re.compile(clock_pattern)
+
+parse_settings = {'PREFER_DATES_FROM': 'future'}
+# Parsed times and whether they are relative, keyed on (text, time zone, minute of the relative base, languages)
+parse_cache = LRUCache(1024)
+date_parsers = {}
+
+
+def normalize(text):
+    return " ".join(text.lower().split())
+
+
+def clock_time(match):
+    """ hour and minute of a matched clock time, None if there is none or it is invalid """
+    if match.group('hour24') is not None:
+        hour = int(match.group('hour24'))
+        minute = int(match.group('minute24'))
+    elif match.group('hour') is not None:
+        hour = int(match.group('hour'))
+        minute = int(match.group('minute') or 0)
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if match.group('ampm') == 'pm' else 0)
+    else:
+        return 0, 0
+    if hour > 23 or minute > 59:
+        return None
+    return hour, minute
+
+
+def fast_parse(text, base):
+    """ parse the common formats relative to a naive base, returns None for anything else
+
+    Mirrors dateparser with PREFER_DATES_FROM future for these formats.
+    """
+    if text == 'now':
+        return base
+    match = relative_regex.fullmatch(text)
+    if match:
+        amount = match.group('amount')
+        amount = int(amount) if amount.isdigit() else numbers[amount]
+        # Wall clock arithmetic, so a day later is the same time of day across a DST change
+        return base + amount * units[match.group('unit')]
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    match = weekday_regex.fullmatch(text)
+    if match:
+        clock = clock_time(match)
+        if clock is None:
+            return None
+        weekday = [day[:3] for day in weekdays].index(match.group('weekday')[:3])
+        # The same weekday is always next week
+        days = (weekday - base.weekday()) % 7 or 7
+        date = base.date() + datetime.timedelta(days=days)
+        return datetime.datetime.combine(date, datetime.time(*clock))
+    match = date_regexes[0].fullmatch(text) or date_regexes[1].fullmatch(text)
+    if match:
+        clock = clock_time(match)
+        if clock is None:
+            return None
+        month = [month[:3] for month in months].index(match.group('month')[:3]) + 1
+        try:
+            result = datetime.datetime(base.year, month, int(match.group('day')), *clock)
+            if result <= base:
+                result = result.replace(year=base.year + 1)
+        except ValueError:
+            return None
+        return result
+    match = day_regex.fullmatch(text)
+    if match:
+        date = base.date()
+        if match.group('relative') == 'tomorrow':
+            date += datetime.timedelta(days=1)
+            if match.group(0) == 'tomorrow':
+                return datetime.datetime.combine(date, base.time())
+        clock = clock_time(match)
+        if clock is None:
+            return None
+        return datetime.datetime.combine(date, datetime.time(*clock))
+    match = clock_regex.fullmatch(text)
+    if match:
+        clock = clock_time(match)
+        if clock is None:
+            return None
+        result = datetime.datetime.combine(base.date(), datetime.time(*clock))
+        if result < base:
+            result += datetime.timedelta(days=1)
+        return result
+    return None
+
+
+def dateparser_parse(text, tz_name, now):
+    """ dateparser with default settings, detects the language among all locales """
+    parse_settings = {'PREFER_DATES_FROM': 'future'}
+    result = dateparser.parse(text, settings=parse_settings)
+    if result is None:
+        return None
+    if result.tzinfo is None:
+        parse_settings['TIMEZONE'] = tz_name
+        parse_settings['RETURN_AS_TIMEZONE_AWARE'] = True
+        tz = pytz.timezone(tz_name)
+    else:
+        tz = result.tzinfo
+    # Parse again with time zone specific relative base as workaround for upstream issue
+    # Upstream always checks if the time has passed in UTC, not in the specified timezone
+    parse_settings['RELATIVE_BASE'] = datetime.datetime.fromtimestamp(now, tz=tz).replace(tzinfo=None)
+    return dateparser.parse(text, settings=parse_settings)
+
+
+class DateParsers:
+    """ dateparser instances restricted to a few languages, reused between calls
+
+    Without languages dateparser tries every locale it knows, which is slowest for text it cannot parse.
+    """
+
+    def __init__(self, languages):
+        self.languages = languages
+        self.parser = DateDataParser(languages=languages, settings=parse_settings)
+        self.naive_parser = DateDataParser(languages=languages)
+        # Second pass parsers keyed on (time zone, relative base), the base only changes once a minute
+        self.zoned = LRUCache(256)
+        self.warm = False
+
+    def zoned_parser(self, tz_name, base):
+        key = (tz_name, base)
+        parser = self.zoned.get(key)
+        if parser is None:
+            settings = dict(parse_settings, RELATIVE_BASE=base)
+            if tz_name is not None:
+                settings.update(TIMEZONE=tz_name, RETURN_AS_TIMEZONE_AWARE=True)
+            parser = DateDataParser(languages=self.languages, settings=settings)
+            self.zoned.put(key, parser)
+        return parser
+
+    def parse(self, text, tz_name, now):
+        return self.parse_relative(text, tz_name, now)[0]
+
+    def parse_relative(self, text, tz_name, now):
+        """ returns the parsed time and whether it is relative to now, like in 2 hours
+
+        The first pass parses against the current time, only relative results carry its microseconds.
+        """
+        result = self.parser.get_date_data(text)['date_obj']
+        if result is None:
+            return None, False
+        relative = result.microsecond != 0
+        if result.tzinfo is None:
+            tz = pytz.timezone(tz_name)
+        else:
+            # The text names its own time zone
+            tz = result.tzinfo
+            tz_name = None
+        # Parse again with time zone specific relative base as workaround for upstream issue
+        # Upstream always checks if the time has passed in UTC, not in the specified timezone
+        base = datetime.datetime.fromtimestamp(now, tz=tz).replace(tzinfo=None)
+        return self.zoned_parser(tz_name, base).get_date_data(text)['date_obj'], relative
+
+    def parse_naive(self, text):
+        """ parse with dateparser's default settings """
+        return self.naive_parser.get_date_data(text)['date_obj']
+
+    def warm_up(self):
+        """ load the locale data of our languages ahead of the first command """
+        start = time.perf_counter()
+        for text in time_corpus:
+            self.parser.get_date_data(normalize(text))
+        self.warm = True
+        return time.perf_counter() - start
+
+
+def get_date_parsers(languages):
+    languages = tuple(languages)
+    if languages not in date_parsers:
+        date_parsers[languages] = DateParsers(list(languages))
+    return date_parsers[languages]
+
+
+def bot_languages(language):
+    """ the configured language and English, which lotro.com and most players use """
+    languages = ['en']
+    if language and language != 'en':
+        languages.insert(0, language)
+    return languages
+
+
+def parse_time(text, tz_name, now=None, languages=('en',)):
+    """ parse a time in the time zone tz_name, returns a time zone aware datetime or None """
+    if now is None:
+        now = time.time()
+    # Times are parsed relative to the start of the minute, which lets results be reused within that minute.
+    # Relative times get the seconds since then added back.
+    minute = now - now % 60
+    text = normalize(text)
+    key = (text, tz_name, int(minute // 60), tuple(languages))
+    if key in parse_cache:
+        result, relative = parse_cache.get(key)
+    else:
+        tz = pytz.timezone(tz_name)
+        base = datetime.datetime.fromtimestamp(minute, tz=tz).replace(tzinfo=None)
+        result = fast_parse(text, base)
+        if result is None:
+            result, relative = get_date_parsers(languages).parse_relative(text, tz_name, minute)
+        else:
+            relative = text in ('now', 'tomorrow') or relative_regex.fullmatch(text) is not None
+            if result.tzinfo is None:
+                result = tz.localize(result)
+        parse_cache.put(key, (result, relative))
+    if result is not None and relative:
+        result += datetime.timedelta(seconds=now - minute)
+    return result
+
+
+# Time arguments as people type them, parsed by warm_up and bench.py
+time_corpus = [
+    "Friday 8pm", "friday 8pm", "Friday 8 pm", "friday 20:00", "Fri 8pm", "saturday 9pm", "Saturday 21:00",
+    "sunday 7:30pm", "Sun 19:30", "monday 8pm", "tuesday 10pm", "wednesday 9:15pm", "thursday 8pm", "thu 20:30",
+    "26 July 1pm", "26 july 13:00", "July 26 1pm", "1 January 8pm", "jan 3 9pm", "14 Feb 8pm", "31 December 11pm",
+    "in two hours", "in 2 hours", "in an hour", "in 30 minutes", "in 10 minutes", "in 3 days", "in a week",
+    "now", "8pm", "20:00", "9:30pm", "10am", "12pm", "tomorrow 8pm", "today 9pm", "tomorrow",
+    "Friday 8pm server", "saturday 21:00 server", "8pm server", "2026-07-26 20:00", "2026-07-26T20:00:00+02:00",
+    "friday 8pm cet", "8pm est", "next friday 8pm", "in 1.5 hours", "tonight 8pm", "friday at 8pm",
+    "26/07 13:00", "noon", "in 2 hours and 30 minutes", "vendredi 20h", "demain 21h",
+]
+
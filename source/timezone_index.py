@@ -0,0 +1,100 @@
+# Time zone lookup for autocomplete, built once at import.
+# Matches prefixes of names and cities, abbreviations like CET or EST, and UTC offsets like UTC+1 or -05:00.
+
+import bisect
+import datetime
+import re
+
+import pytz
+
+from utils import LRUCache, get_partial_matches
+
+offset_regex = re.compile(r'(?:utc|gmt)?\s*(?P<sign>[+-])\s*(?P<hours>\d{1,2})(?::?(?P<minutes>\d{2}))?')
+# Match quality, lower is better
+EXACT, PREFIX = 0, 1
+
+
+def normalize(text):
+    return " ".join(text.lower().replace("_", " ").split())
+
+
+def parse_offset(query):
+    """ an offset query in minutes, None if the query is not an offset """
+    match = offset_regex.fullmatch(query)
+    if not match:
+        return None
+    minutes = int(match.group('hours')) * 60 + int(match.group('minutes') or 0)
+    if match.group('sign') == '-':
+        minutes = -minutes
+    return minutes
+
+
+class TimeZoneIndex:
+    """ prefix, token and alias index over time zone names, ranked by popularity """
+
+    def __init__(self, timezones, common_timezones, limit=25):
+        self.limit = limit
+        self.common = common_timezones[:limit]
+        # Common time zones first in their listed order, the rest alphabetically
+        self.names = common_timezones + sorted(set(timezones) - set(common_timezones))
+        self.rank = {tz: i for i, tz in enumerate(self.names)}
+        keys = set()
+        self.offsets = {}
+        year = datetime.datetime.now().year
+        for tz in self.names:
+            for key in self.aliases(tz):
+                keys.add((key, self.rank[tz]))
+            zone = pytz.timezone(tz)
+            # Winter and summer on both hemispheres
+            for month in (1, 7):
+                local = zone.localize(datetime.datetime(year, month, 1))
+                name = local.tzname()
+                if name.isalpha():
+                    keys.add((name.lower(), self.rank[tz]))
+                offset = int(local.utcoffset().total_seconds() // 60)
+                self.offsets.setdefault(offset, set()).add(self.rank[tz])
+        self.keys = sorted(keys)
+        self.words = [key for key, rank in self.keys]
+        self.offsets = {offset: sorted(ranks) for offset, ranks in self.offsets.items()}
+        self.cache = LRUCache(1024)
+
+    @staticmethod
+    def aliases(tz):
+        """ the full name, every part of it and the city """
+        name = normalize(tz)
+        parts = name.split("/")
+        aliases = {name, parts[-1]}
+        for part in parts:
+            aliases.update(part.split())
+        return aliases
+
+    def prefix_matches(self, query):
+        """ best match quality of every time zone with a key starting with the query """
+        matches = {}
+        start = bisect.bisect_left(self.words, query)
+        for key, rank in self.keys[start:]:
+            if not key.startswith(query):
+                break
+            quality = EXACT if key == query else PREFIX
+            if quality < matches.get(rank, PREFIX + 1):
+                matches[rank] = quality
+        return sorted(matches, key=lambda rank: (matches[rank], rank))
+
+    def search(self, query):
+        query = normalize(query)
+        if not query:
+            return self.common
+        result = self.cache.get(query)
+        if result is not None:
+            return result
+        offset = parse_offset(query)
+        if offset is not None:
+            ranks = self.offsets.get(offset, [])
+        else:
+            ranks = self.prefix_matches(query)
+        result = [self.names[rank] for rank in ranks[:self.limit]]
+        if not result and offset is None:
+            # Nothing starts with the query, allow typos
+            result = get_partial_matches(query, self.names, limit=self.limit) or []
+        self.cache.put(query, result)
+        return result
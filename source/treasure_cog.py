@@ -1,130 +1,95 @@
+import asyncio
+import bisect
 import discord
+import functools
+import hashlib
 import logging
-import re
-import xml.etree.ElementTree as ET
+
+from collections import defaultdict
 
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 from typing import Optional
 
+from loot_index import ItemDrop, data_signature, load_loot_data, open_index, read_data_version
+from loot_simulator import percentiles, simulate
 from raid_cog import Classes
-from utils import get_partial_matches
+from utils import LRUCache, NgramIndex
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-data_version = ""
-with open('__init__.py') as f:
-    regex = r'^__lotro__\s*=\s*[\'"]([^\'"]*)[\'"]'
-    data_version = re.search(regex, f.read(), re.MULTILINE).group(1)
-
-#Parse XML file
-tree = ET.parse('../data/lore/containers.xml')
-containerRoot = tree.getroot()
-containers = {child.attrib['id']: child.attrib['name'] for child in containerRoot}
-tree = ET.parse('../data/lore/loots.xml')
-root = tree.getroot()
-itemsTables = root.findall("itemsTable")
-filteredTrophyTables = root.findall("filteredTrophyTable")
-weightedTreasureTables = root.findall("weightedTreasureTable")
-trophyLists = root.findall("trophyList")
-treasureLists = root.findall("treasureList")
-
 traceryIDs = ['1879428517', '1879428521', '1879428563', '1879428567']
 
+embedLimits = {'value': 1024, 'count': 25, 'total': 6000}
+# Simulations running at once, each holds one chunk of openings in memory
+maxSimulations = 2
+
 
 #heavy = "Beorning;Captain;Champion;Guardian;Brawler"
 #medium = "Burglar;Hunter;Corsair;Warden"
 #light = "Lore-master;Minstrel;Rune-keeper"
 
-def getContainerContents(containerID):
-    filteredTrophyTableIDs = []
-    trophyListIDs = []
-    treasureListIDs = []
-    for child in containerRoot:
-        if child.attrib['id'] == containerID:
-            try:
-                filteredTrophyTableIDs.append(child.attrib['filteredTrophyTableId'])
-                filteredTrophyTableIDs.append(child.attrib['filteredTrophyTableId2'])
-                filteredTrophyTableIDs.append(child.attrib['filteredTrophyTableId3'])
-            except KeyError:
-                pass
-            try:
-                trophyListIDs.append([(1, child.attrib['trophyListId'])])
-            except KeyError:
-                pass
-            try:
-                trophyListIDs.append([(1, child.attrib['barterTrophyListId'])])
-            except KeyError:
-                pass
-            try:
-                treasureListIDs.append(child.attrib['treasureListId'])
-            except KeyError:
-                pass
-            try:
-                child.attrib['weightedTreasureTableId']
-                #TODO
-                raise NotImplementedError
-            except KeyError:
-                pass
+def memoized(kind):
+    """Stores the resolution of a sub-table on the loot data, tables shared by many containers are resolved once"""
+    def decorator(resolve):
+        @functools.wraps(resolve)
+        def wrapper(data, tableID):
+            key = (kind, tableID)
             try:
-                child.attrib['skirmishLootTableId']
-                #TODO
-                raise NotImplementedError
+                return data.resolved[key]
             except KeyError:
-                pass
-            return (filteredTrophyTableIDs, trophyListIDs, treasureListIDs)
+                result = resolve(data, tableID)
+                data.resolved[key] = result
+                return result
+        return wrapper
+    return decorator
 
-def getTrophyListFromWeightedTreasureTable(weightedTreasureTableID, weightedTreasureTables):
+def getContainerContents(data, containerID):
+    container = data.containers.get(containerID)
+    if container is None:
+        return
+    filteredTrophyTableIDs = list(container.filteredTrophyTableIds)
     trophyListIDs = []
-    for element in weightedTreasureTables:
-        if element.attrib['id'] == weightedTreasureTableID:
-            total = 0
-            for entry in element:
-                attributes = entry.attrib
-                weight = int(attributes['weight'])
-                total += weight
-                trophyListID = attributes['trophyListId']
-                trophyListIDs.append([weight, trophyListID])
-            for trophyListID in trophyListIDs:
-                trophyListID[0] = trophyListID[0]/total
-            return trophyListIDs
-
-def getTrophyListIDs(filteredTrophyTableIDs, trophyListIDs, _class, level):
+    treasureListIDs = []
+    skirmishLootTableIDs = []
+    if container.trophyListId:
+        trophyListIDs.append([(1, container.trophyListId)])
+    if container.barterTrophyListId:
+        trophyListIDs.append([(1, container.barterTrophyListId)])
+    if container.treasureListId:
+        treasureListIDs.append(container.treasureListId)
+    if container.weightedTreasureTableId:
+        trophyListIDs.append(getTrophyListFromWeightedTreasureTable(data, container.weightedTreasureTableId))
+    if container.skirmishLootTableId:
+        skirmishLootTableIDs.append(container.skirmishLootTableId)
+    return (filteredTrophyTableIDs, trophyListIDs, treasureListIDs, skirmishLootTableIDs)
+
+@memoized('weightedTreasureTable')
+def getTrophyListFromWeightedTreasureTable(data, weightedTreasureTableID):
+    entries = data.weightedTreasureTables.get(weightedTreasureTableID, ())
+    total = sum(entry.weight for entry in entries)
+    return tuple((entry.weight/total, entry.trophyListId) for entry in entries)
+
+def matchesEntry(entry, _class, level):
+    if entry.minLevel is not None and entry.minLevel > level:
+        return False
+    if entry.maxLevel is not None and entry.maxLevel < level:
+        return False
+    if entry.requiredClass is not None and _class not in entry.requiredClass:
+        return False
+    return True
+
+def getTrophyListIDs(data, filteredTrophyTableIDs, trophyListIDs, _class, level):
     for filteredTrophyTableID in filteredTrophyTableIDs:
-        for element in filteredTrophyTables:
-            if element.attrib['id'] == filteredTrophyTableID:
-                for entry in element:
-                    try:
-                        minLevel = int(entry.attrib['minLevel'])
-                    except KeyError:
-                        pass
-                    else:
-                        if minLevel > level:
-                            continue
-                    try:
-                        maxLevel = int(entry.attrib['maxLevel'])
-                    except KeyError:
-                        pass
-                    else:
-                        if maxLevel < level:
-                            continue
-                    try:
-                        requiredClass = entry.attrib['requiredClass']
-                    except KeyError:
-                        pass
-                    else:
-                        if _class not in requiredClass:
-                            continue
-                    try:
-                        trophyListID = entry.attrib['trophyListId']
-                        trophyListIDs.append([(1, trophyListID)])
-                    except KeyError:
-                        weightedTreasureTableID = entry.attrib['weightedTreasureTableId']
-                        result = getTrophyListFromWeightedTreasureTable(weightedTreasureTableID, weightedTreasureTables)
-                        trophyListIDs.append(result)
-                        pass
-                break
+        for entry in data.filteredTrophyTables.get(filteredTrophyTableID, ()):
+            if not matchesEntry(entry, _class, level):
+                continue
+            if entry.trophyListId is not None:
+                trophyListIDs.append([(1, entry.trophyListId)])
+            else:
+                result = getTrophyListFromWeightedTreasureTable(data, entry.weightedTreasureTableId)
+                trophyListIDs.append(result)
     return trophyListIDs
 
 def formatNumber(number):
@@ -136,35 +101,30 @@ def formatNumber(number):
         string = "%.4f" % number
     return string
 
-def getItemsFromTreasureGroup(treasureGroupProfileID, container_frequency):
-    drops = []
-    for element in itemsTables:
-        if element.attrib['id'] == treasureGroupProfileID:
-            total = 0
-            for entry in element:
-                attributes = entry.attrib
-                weight = int(attributes['weight'])
-                total += weight
-                name = attributes['name']
-                try:
-                    quantity = attributes['quantity'] + " "
-                except KeyError:
-                    quantity = ""
-                drops.append({'quantity': quantity, 'name': name, 'weight': weight})
-            for drop in drops:
-                percentage = drop['weight']/total * 100 * container_frequency
-                drop['percentage'] = formatNumber(percentage)
-            drops = sorted(drops, key=lambda d: -d['weight'])
-            result = ["{0}% -- {1}{2}".format(drop['percentage'], drop['quantity'], drop['name']) for drop in drops]
-            return result
+@memoized('treasureGroup')
+def getTreasureGroupVector(data, treasureGroupProfileID):
+    """Returns the (probability, quantity, name) of every item a treasure group can roll, most likely first"""
+    entries = data.itemsTables.get(treasureGroupProfileID)
+    if entries is not None:
+        total = sum(entry.weight for entry in entries)
+        drops = sorted(entries, key=lambda entry: -entry.weight)
+        return tuple((drop.weight/total, drop.quantity, drop.name) for drop in drops)
     #For old chests treasureGroup can point to treasureList instead of itemList directly
-    for element in treasureLists:
-        if element.attrib['id'] == treasureGroupProfileID:
-            for entry in element:
-                result = getItemsFromTreasureGroup( entry.attrib['treasureGroupProfileId'], container_frequency)
-                return(result)
+    for entry in data.treasureLists.get(treasureGroupProfileID, ()):
+        return getTreasureGroupVector(data, entry.treasureGroupProfileId)
+
+def getItemsFromTreasureGroup(data, treasureGroupProfileID, container_frequency):
+    vector = getTreasureGroupVector(data, treasureGroupProfileID)
+    if vector is None:
+        return None
+    result = []
+    for probability, quantity, name in vector:
+        percentage = formatNumber(probability * 100 * container_frequency)
+        quantity = quantity + " " if quantity is not None else ""
+        result.append("{0}% -- {1}{2}".format(percentage, quantity, name))
+    return result
 
-def getItemDrops(trophyListIDs):
+def getItemDrops(data, trophyListIDs):
     loot = []
     for trophyListIDSet in trophyListIDs:
         if len(trophyListIDSet) > 1:
@@ -174,51 +134,335 @@ def getItemDrops(trophyListIDs):
         else:
             weightedGroup = False
         for trophyListID in trophyListIDSet:
-            for element in trophyLists:
-                if element.attrib['id'] == trophyListID[1]:
-                    if weightedGroup:
-                        assert(len(element) == 1)
-                    for entry in element:
-                        try:
-                            treasureGroup = entry.attrib['treasureGroupProfileId']
-                        except KeyError:
-                            item = entry.attrib['name']
-                            try:
-                                quantity = entry.attrib['quantity'] + " "
-                            except KeyError:
-                                quantity = ""
-                            if weightedGroup:
-                                percentage = formatNumber(trophyListID[0] * 100)
-                                item = ["{0}% -- {1}{2}".format(percentage, quantity, item)]
-                            else:
-                                item = ["100% -- " + quantity + item]
-                        else:
-                            item = getItemsFromTreasureGroup(treasureGroup, trophyListID[0])
-                        frequency = float(entry.attrib['dropFrequency']) * 100
-                        if weightedGroup:
-                            assert(int(frequency) == 100)
-                            loot[index][1].extend(item)
-                        else:
-                            loot.append([frequency, item])
-                    break
+            entries = data.trophyLists.get(trophyListID[1], ())
+            for entry in entries:
+                # Only lists dropping a single item for sure fit in the weighted group, others get their own field
+                grouped = weightedGroup and len(entries) == 1 and entry.dropFrequency == 1
+                if entry.treasureGroupProfileId is None:
+                    quantity = entry.quantity + " " if entry.quantity is not None else ""
+                    if grouped:
+                        percentage = formatNumber(trophyListID[0] * 100)
+                        item = ["{0}% -- {1}{2}".format(percentage, quantity, entry.name)]
+                    else:
+                        item = ["100% -- " + quantity + entry.name]
+                elif grouped or not weightedGroup:
+                    item = getItemsFromTreasureGroup(data, entry.treasureGroupProfileId, trophyListID[0])
+                else:
+                    item = getItemsFromTreasureGroup(data, entry.treasureGroupProfileId, 1)
+                frequency = entry.dropFrequency * 100
+                if grouped:
+                    loot[index][1].extend(item)
+                elif weightedGroup:
+                    loot.append([frequency * trophyListID[0], item])
+                else:
+                    loot.append([frequency, item])
+        if weightedGroup and not loot[index][1]:
+            del loot[index]
+    return loot
+
+def getSkirmishDrops(data, skirmishLootTableID, _class, level):
+    loot = []
+    for entry in data.skirmishLootTables.get(skirmishLootTableID, ()):
+        if not matchesEntry(entry, _class, level):
+            continue
+        if entry.treasureGroupProfileId is not None:
+            item = getItemsFromTreasureGroup(data, entry.treasureGroupProfileId, 1)
+            if item:
+                loot.append([entry.dropFrequency * 100, item])
+        elif entry.trophyListId is not None:
+            for frequency, item in getItemDrops(data, [[(1, entry.trophyListId)]]):
+                loot.append([frequency * entry.dropFrequency, item])
     return loot
 
-def appendTreasureDrops(treasureListIDs, loot):
+def appendTreasureDrops(data, treasureListIDs, loot):
     for treasureListID in treasureListIDs:
-        for element in treasureLists:
-            if element.attrib['id'] == treasureListID:
-                for entry in element:
-                    treasureGroup = entry.attrib['treasureGroupProfileId']
-                    item = getItemsFromTreasureGroup(treasureGroup, 1)
-                    #frequency = float(entry.attrib['dropFrequency']) * 100
-                    loot.append([-1, item])
-                break
+        for entry in data.treasureLists.get(treasureListID, ()):
+            item = getItemsFromTreasureGroup(data, entry.treasureGroupProfileId, 1)
+            #frequency = float(entry.attrib['dropFrequency']) * 100
+            loot.append([-1, item])
     return loot
 
-def generateLootEmbed(loot, container, level, classes):
-    title = _("Drop table for {0}").format(container)
-    desc = _("Level {0} {1}").format(level, classes)
-    embed = discord.Embed(title=title, description=desc, colour=discord.Colour(0x3498db))
+def resolveLoot(data, containerID, _class, level, tracery):
+    """Returns the drop table of a container as a list of [frequency, [drop strings]]"""
+    filteredTrophyTableIDs, trophyListIDs, treasureListIDs, skirmishLootTableIDs = getContainerContents(data, containerID)
+    traceryID = []
+    if not tracery:
+        traceryID = [_id for _id in filteredTrophyTableIDs if _id in traceryIDs]
+        for _traceryID in traceryID:
+            filteredTrophyTableIDs.remove(_traceryID)
+    queryClass = override_player_class(_class)
+    trophyListIDs = getTrophyListIDs(data, filteredTrophyTableIDs, trophyListIDs, queryClass, level)
+    loot = getItemDrops(data, trophyListIDs)
+    for skirmishLootTableID in skirmishLootTableIDs:
+        loot.extend(getSkirmishDrops(data, skirmishLootTableID, queryClass, level))
+    if not tracery and traceryID and level>=50:
+        if len(traceryID)==1:
+            loot.append((100, [_("A tracery (pass tracery=True to expand this list)")]))
+        else:
+            loot.append((100, [_("{0} traceries (pass tracery=True to expand this list)").format(len(traceryID))]))
+    return appendTreasureDrops(data, treasureListIDs, loot)
+
+def getTrophyListRolls(data, trophyListIDSet):
+    """Returns the independent rolls of a set of trophy lists as (chance, [(probability, name)])"""
+    rolls = []
+    group = []
+    weightedGroup = len(trophyListIDSet) > 1
+    for weight, trophyListID in trophyListIDSet:
+        entries = data.trophyLists.get(trophyListID, ())
+        for entry in entries:
+            grouped = weightedGroup and len(entries) == 1 and entry.dropFrequency == 1
+            if entry.treasureGroupProfileId is None:
+                items = [(1, entry.name)]
+            else:
+                items = list(getTreasureGroupItems(data, entry.treasureGroupProfileId))
+                items = [(probability, name) for name, probability in items]
+            if grouped:
+                group.extend((weight * probability, name) for probability, name in items)
+            elif weightedGroup:
+                rolls.append((weight * entry.dropFrequency, items))
+            else:
+                rolls.append((entry.dropFrequency, items))
+    if group:
+        rolls.append((1, group))
+    return rolls
+
+def getLootRolls(data, containerID, _class, level):
+    """Returns the rolls made when opening a container, treasure lists are left out as their chance is unknown"""
+    filteredTrophyTableIDs, trophyListIDs, treasureListIDs, skirmishLootTableIDs = getContainerContents(data, containerID)
+    queryClass = override_player_class(_class)
+    rolls = []
+    for trophyListIDSet in getTrophyListIDs(data, filteredTrophyTableIDs, trophyListIDs, queryClass, level):
+        rolls.extend(getTrophyListRolls(data, trophyListIDSet))
+    for skirmishLootTableID in skirmishLootTableIDs:
+        for entry in data.skirmishLootTables.get(skirmishLootTableID, ()):
+            if not matchesEntry(entry, queryClass, level):
+                continue
+            if entry.treasureGroupProfileId is not None:
+                items = getTreasureGroupItems(data, entry.treasureGroupProfileId)
+                rolls.append((entry.dropFrequency, [(probability, name) for name, probability in items]))
+            elif entry.trophyListId is not None:
+                for chance, items in getTrophyListRolls(data, [(1, entry.trophyListId)]):
+                    rolls.append((chance * entry.dropFrequency, items))
+    return rolls
+
+def getLevelBreakpoints(snapshot, containerID):
+    """Returns the sorted levels at which the drop table of a container can change"""
+    data = snapshot.data
+    breakpoints = snapshot.levelBreakpoints.get(containerID)
+    if breakpoints is None:
+        # Traceries are summarised from level 50
+        points = {50}
+        container = data.containers[containerID]
+        entries = [entry for filteredTrophyTableID in container.filteredTrophyTableIds
+                   for entry in data.filteredTrophyTables.get(filteredTrophyTableID, ())]
+        entries.extend(data.skirmishLootTables.get(container.skirmishLootTableId, ()))
+        for entry in entries:
+            if entry.minLevel is not None:
+                points.add(entry.minLevel)
+            if entry.maxLevel is not None:
+                points.add(entry.maxLevel + 1)
+        breakpoints = sorted(points)
+        snapshot.levelBreakpoints[containerID] = breakpoints
+    return breakpoints
+
+def getLoot(snapshot, containerID, _class, level, tracery):
+    """Cached resolveLoot, levels without a table boundary between them share an entry"""
+    bucket = bisect.bisect_right(getLevelBreakpoints(snapshot, containerID), level)
+    key = (containerID, _class, bucket, tracery)
+    loot = snapshot.lootCache.get(key)
+    if loot is None:
+        loot = resolveLoot(snapshot.data, containerID, _class, level, tracery)
+        snapshot.lootCache.put(key, loot)
+    return loot
+
+def getLootPages(snapshot, containerID, _class, level, tracery):
+    key = (containerID, _class, level, tracery)
+    pages = snapshot.pageCache.get(key)
+    if pages is None:
+        loot = getLoot(snapshot, containerID, _class, level, tracery)
+        container = snapshot.containers[containerID]
+        title = _("Drop table for {0}").format(container)
+        desc = _("Level {0} {1}").format(level, _class)
+        reserved = len(title) + len(desc) + len(lootFooter(snapshot.version, 999, 999))
+        pages = paginateFields(getLootFields(loot, container), reserved)
+        snapshot.pageCache.put(key, pages)
+    return pages
+
+def getTreasureGroupItems(data, treasureGroupProfileID):
+    """Yields the (name, probability) of every item a treasure group can roll"""
+    for probability, quantity, name in getTreasureGroupVector(data, treasureGroupProfileID) or ():
+        yield name, probability
+
+def getTrophyListItems(data, trophyListID, weight):
+    """Yields the (name, probability) of every item a trophy list picked with the given weight can drop"""
+    for entry in data.trophyLists.get(trophyListID, ()):
+        if entry.treasureGroupProfileId is None:
+            yield entry.name, weight * entry.dropFrequency
+        else:
+            for name, probability in getTreasureGroupItems(data, entry.treasureGroupProfileId):
+                yield name, weight * entry.dropFrequency * probability
+
+def combineProbabilities(previous, probability):
+    """Chance of at least one drop from two independent rolls, None if either chance is unknown"""
+    if previous is None or probability is None:
+        return None
+    return 1 - (1 - previous) * (1 - probability)
+
+def choiceValue(name):
+    """Autocomplete values are limited to 100 characters, longer names are cut and get a hash of the full name"""
+    if len(name) <= 100:
+        return name
+    return name[:91] + "#" + hashlib.sha1(name.encode()).hexdigest()[:8]
+
+class ItemIndex:
+    """Reverse lookup of the containers that can drop an item
+
+    Items map to the trophy and treasure lists containing them and lists map to the containers rolling them,
+    the drops of an item are only expanded when it is looked up.
+    """
+
+    def __init__(self, data):
+        # item name -> {(kind, list id): probability within the list}
+        self.lists = defaultdict(dict)
+        # (kind, list id) -> [((container, class, min level, max level), weight of the list)]
+        self.sources = defaultdict(list)
+        self.cache = LRUCache(256)
+        for containerID in data.containers:
+            contents = getContainerContents(data, containerID)
+            filteredTrophyTableIDs, trophyListIDs, treasureListIDs, skirmishLootTableIDs = contents
+            entries = [(None, None, None, trophyListIDSet) for trophyListIDSet in trophyListIDs]
+            for filteredTrophyTableID in filteredTrophyTableIDs:
+                for entry in data.filteredTrophyTables.get(filteredTrophyTableID, ()):
+                    if entry.trophyListId is not None:
+                        trophyListIDSet = [(1, entry.trophyListId)]
+                    else:
+                        trophyListIDSet = getTrophyListFromWeightedTreasureTable(data, entry.weightedTreasureTableId)
+                    entries.append((entry.requiredClass, entry.minLevel, entry.maxLevel, trophyListIDSet))
+            for requiredClass, minLevel, maxLevel, trophyListIDSet in entries:
+                key = (containerID, requiredClass, minLevel, maxLevel)
+                for weight, trophyListID in trophyListIDSet:
+                    self.addSource(('trophyList', trophyListID), key, weight,
+                                   lambda: getTrophyListItems(data, trophyListID, 1))
+            for skirmishLootTableID in skirmishLootTableIDs:
+                for entry in data.skirmishLootTables.get(skirmishLootTableID, ()):
+                    key = (containerID, entry.requiredClass, entry.minLevel, entry.maxLevel)
+                    if entry.treasureGroupProfileId is not None:
+                        self.addSource(('treasureGroup', entry.treasureGroupProfileId), key, entry.dropFrequency,
+                                       lambda: getTreasureGroupItems(data, entry.treasureGroupProfileId))
+                    elif entry.trophyListId is not None:
+                        self.addSource(('trophyList', entry.trophyListId), key, entry.dropFrequency,
+                                       lambda: getTrophyListItems(data, entry.trophyListId, 1))
+            for treasureListID in treasureListIDs:
+                self.addSource(('treasureList', treasureListID), (containerID, None, None, None), None,
+                               lambda: ((name, None) for entry in data.treasureLists.get(treasureListID, ())
+                                        for name, probability in getTreasureGroupItems(data, entry.treasureGroupProfileId)))
+        self.names = NgramIndex({name: name for name in self.lists})
+        # Autocomplete value -> full name for the names that do not fit a value
+        self.choiceNames = {choiceValue(name): name for name in self.lists if len(name) > 100}
+
+    def addSource(self, listKey, key, weight, items):
+        if listKey not in self.sources:
+            for name, probability in items():
+                if listKey in self.lists[name]:
+                    probability = combineProbabilities(self.lists[name][listKey], probability)
+                self.lists[name][listKey] = probability
+        self.sources[listKey].append((key, weight))
+
+    def __contains__(self, name):
+        return name in self.lists
+
+    def fromChoice(self, value):
+        """Returns the item name of an autocomplete value, or the value if it is a name typed in full"""
+        return self.choiceNames.get(value, value)
+
+    def __len__(self):
+        return len(self.lists)
+
+    def getDrops(self, name):
+        """Returns the containers dropping an item as ItemDrops, most likely first"""
+        drops = self.cache.get(name)
+        if drops is None:
+            locations = {}
+            for listKey, probability in self.lists[name].items():
+                for key, weight in self.sources[listKey]:
+                    if probability is not None and weight is not None:
+                        chance = weight * probability
+                    else:
+                        chance = None
+                    if key in locations:
+                        # The container rolls both tables
+                        chance = combineProbabilities(locations[key], chance)
+                    locations[key] = chance
+            drops = sorted((ItemDrop(*key, probability) for key, probability in locations.items()),
+                           key=lambda drop: -1 if drop.probability is None else -drop.probability)
+            self.cache.put(name, drops)
+        return drops
+
+class LootSnapshot:
+    """Everything derived from one version of lotro-data, reloading replaces it as a whole
+
+    Requests hold on to the snapshot they started with, the caches go away with their snapshot.
+    """
+
+    def __init__(self, data, signature):
+        self.data = data
+        self.version = data.data_version
+        self.signature = signature
+        self.containers = {containerID: container.name for containerID, container in data.containers.items()}
+        self.containerIndex = NgramIndex(self.containers)
+        # Reverse lookup of the containers dropping an item
+        self.itemIndex = ItemIndex(data)
+        # Resolved drop tables keyed on (container, class, level bucket, tracery)
+        self.lootCache = LRUCache(2048)
+        # Embed fields split into pages keyed on (container, class, level, tracery)
+        self.pageCache = LRUCache(512)
+        self.levelBreakpoints = {}
+
+def loadLootSnapshot():
+    """Loads the precompiled loot index, this only parses the XML files if they changed"""
+    data_version = read_data_version()
+    signature = data_signature(data_version)
+    lootIndex = open_index(data_version=data_version)
+    try:
+        data = load_loot_data(lootIndex, data_version)
+    finally:
+        lootIndex.close()
+    return LootSnapshot(data, signature)
+
+def generateDropsEmbed(snapshot, name, drops):
+    title = _("Drop locations for {0}").format(name)
+    embed = discord.Embed(title=title, colour=discord.Colour(0x3498db))
+    lines = []
+    length = 0
+    for i, drop in enumerate(drops):
+        if drop.probability is None:
+            line = "??% -- " + snapshot.containers[drop.containerID]
+        else:
+            line = "{0}% -- {1}".format(formatNumber(drop.probability * 100), snapshot.containers[drop.containerID])
+        details = []
+        if drop.minLevel is not None and drop.maxLevel is not None:
+            details.append(_("level {0}-{1}").format(drop.minLevel, drop.maxLevel))
+        elif drop.minLevel is not None:
+            details.append(_("level {0}+").format(drop.minLevel))
+        elif drop.maxLevel is not None:
+            details.append(_("up to level {0}").format(drop.maxLevel))
+        if drop.requiredClass is not None:
+            details.append(drop.requiredClass.replace(";", ", "))
+        if details:
+            line += " ({0})".format("; ".join(details))
+        # Leave room for the final line
+        if length + len(line) > 3900:
+            lines.append(_("... and {0} more.").format(len(drops) - i))
+            break
+        lines.append(line)
+        length += len(line) + 1
+    embed.description = "\n".join(lines)
+    embed.set_footer(text=lootFooter(snapshot.version))
+    return embed
+
+def getLootFields(loot, container):
+    """Splits a drop table into (name, value) embed fields of at most 20 drops that fit the field limit"""
+    fields = []
     blocksize = 20
     for pair in loot:
         try:
@@ -226,29 +470,95 @@ def generateLootEmbed(loot, container, level, classes):
         except:
             logger.debug("Empty loot for {0}:\n{1}".format(container, loot))
             raise
-        for i in range(0, len(pair[1]), blocksize):
-            items = pair[1][i:i+blocksize]
-            msg = "\n".join(items)
-            if i == 0:
-                if pair[0] == -1:
-                    field_name = _("??% chance to get one of the following:")
-                else:
-                    field_name = _("%.3g%% chance to get one of the following:") % pair[0]
-            else:
+        if pair[0] == -1:
+            field_name = _("??% chance to get one of the following:")
+        else:
+            field_name = _("%.3g%% chance to get one of the following:") % pair[0]
+        items = []
+        for item in pair[1]:
+            if len(items) == blocksize or len("\n".join(items + [item])) > embedLimits['value']:
+                fields.append((field_name, "\n".join(items)))
                 field_name = "\u200b"
-            embed.add_field(name=field_name, value=msg, inline=False)
-    embed.set_footer(text=_("Powered by LotroCompanion. Data as of U{0}").format(data_version))
+                items = []
+            items.append(item)
+        if items:
+            fields.append((field_name, "\n".join(items)))
+    return fields
+
+def paginateFields(fields, reserved):
+    """Packs fields into pages within the field count and total size limits of an embed"""
+    pages = []
+    page = []
+    size = reserved
+    for name, value in fields:
+        length = len(name) + len(value)
+        if page and (len(page) == embedLimits['count'] or size + length > embedLimits['total']):
+            pages.append(page)
+            page = []
+            size = reserved
+        page.append((name, value))
+        size += length
+    pages.append(page)
+    return pages
+
+def lootFooter(version, page=0, pages=1):
+    footer = _("Powered by LotroCompanion. Data as of U{0}").format(version)
+    if pages > 1:
+        footer += " - " + _("Page {0}/{1}").format(page + 1, pages)
+    return footer
+
+def generateLootEmbed(fields, container, level, classes, version, page=0, pages=1):
+    title = _("Drop table for {0}").format(container)
+    desc = _("Level {0} {1}").format(level, classes)
+    embed = discord.Embed(title=title, description=desc, colour=discord.Colour(0x3498db))
+    for name, value in fields:
+        embed.add_field(name=name, value=value, inline=False)
+    embed.set_footer(text=lootFooter(version, page, pages))
     return embed
 
+def generateSimulationEmbed(results, container, level, classes, runs, item):
+    title = _("Simulated {0} openings of {1}").format(runs, container)
+    desc = _("Level {0} {1}").format(level, classes)
+    embed = discord.Embed(title=title, description=desc, colour=discord.Colour(0x3498db))
+    if item:
+        results = [result for result in results if item.lower() in result.name.lower()]
+    header = _("Runs needed for a {0} chance").format(", ".join("{0}%".format(q) for q in percentiles))
+    for result in results[:20]:
+        if result.expected_runs is None:
+            value = _("Did not drop.")
+        else:
+            value = _("Dropped in {0}% of runs, {1:.1f} runs on average.").format(
+                formatNumber(result.chance * 100), result.expected_runs)
+            value += "\n" + header + ": " + ", ".join(str(runs) for runs in result.percentiles)
+        embed.add_field(name=result.name, value=value, inline=False)
+    if len(results) > 20:
+        embed.set_footer(text=_("{0} more items not shown.").format(len(results) - 20))
+    elif not results:
+        embed.description += "\n" + _("No matching items.")
+    return embed
+
+# Loaded by TreasureCog.cog_load, off the event loop
+lootSnapshot = None
+
 async def container_autocomplete(interaction: discord.Interaction, current: str):
     if not current:
         return []
-    suggestions = get_partial_matches(current, containers, keys=True)
+    snapshot = lootSnapshot
+    suggestions = snapshot.containerIndex.search(current)
     return [
-        app_commands.Choice(name=containers[containerID], value=containerID)
+        app_commands.Choice(name=snapshot.containers[containerID], value=containerID)
         for containerID in suggestions
     ]
 
+async def item_autocomplete(interaction: discord.Interaction, current: str):
+    if not current:
+        return []
+    suggestions = lootSnapshot.itemIndex.names.search(current)
+    return [
+        app_commands.Choice(name=name[:100], value=choiceValue(name))
+        for name in suggestions
+    ]
+
 def override_player_class(_class):
     match _class:
         case "Loremaster":
@@ -263,59 +573,166 @@ def override_player_class(_class):
 class TreasureCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.reload_lock = asyncio.Lock()
+        self.simulations = asyncio.Semaphore(maxSimulations)
+
+    async def cog_load(self):
+        global lootSnapshot
+        async with self.reload_lock:
+            if lootSnapshot is None:
+                # Building the index and the search indexes takes seconds, keep the gateway responsive meanwhile
+                lootSnapshot = await asyncio.to_thread(loadLootSnapshot)
+        if self.bot.loot_watch:
+            self.watch_task.change_interval(seconds=int(self.bot.loot_watch))
+            self.watch_task.start()
+
+    async def cog_unload(self):
+        self.watch_task.cancel()
+
+    async def reload_loot(self):
+        """Rebuilds the loot data in a worker thread and swaps it in, returns the old and new snapshot"""
+        global lootSnapshot
+        async with self.reload_lock:
+            old = lootSnapshot
+            snapshot = await asyncio.to_thread(loadLootSnapshot)
+            # Requests in progress keep using the old snapshot
+            lootSnapshot = snapshot
+        logger.info("Reloaded loot data, U{0} -> U{1}.".format(old.version, snapshot.version))
+        return old, snapshot
+
+    @tasks.loop(seconds=300)
+    async def watch_task(self):
+        try:
+            signature = await asyncio.to_thread(data_signature, read_data_version())
+        except OSError as e:
+            logger.warning("Could not check the loot data: {0}".format(e))
+            return
+        if signature != lootSnapshot.signature:
+            try:
+                await self.reload_loot()
+            except Exception as e:
+                # The files may still be changing, try again next time
+                logger.warning("Reloading the loot data failed: {0}".format(e))
+
+    @watch_task.error
+    async def handle_error(self, exception):
+        logger.error("Loot data watcher failed.")
+        logger.error(exception, exc_info=True)
 
     @app_commands.command(name=_("loot"), description=_("Shows drop chances for loot."))
     @app_commands.guild_only()
     @app_commands.describe(chest=_("The name of the container to see the drop table for."), classes=_("The class for which to see the drop table."), level=_("The character level for which to see the drop table."), tracery=_("Whether the tracery drop table should be shown in full."))
     @app_commands.autocomplete(chest=container_autocomplete)
     async def loot_respond(self, interaction: discord.Interaction, chest: str, classes: Optional[Classes]=Classes.Captain, level: Optional[app_commands.Range[int, 1, 160]]=160, tracery: Optional[bool]=False):
-        if chest not in containers.keys():
+        snapshot = lootSnapshot
+        if chest not in snapshot.containers.keys():
             await interaction.response.send_message(_("Unknown container."))
             return
-        try:
-            filteredTrophyTableIDs, trophyListIDs, treasureListIDs = getContainerContents(chest)
-        except NotImplementedError:
-            await interaction.response.send_message(_("Cannot parse obsolete container."))
+        _class = classes.name
+        container = snapshot.containers[chest]
+        pages = getLootPages(snapshot, chest, _class, level, tracery)
+        if len(pages) == 1:
+            embed = generateLootEmbed(pages[0], container, level, _class, snapshot.version)
+            await interaction.response.send_message(embed=embed)
             return
-        if not tracery:
-            traceryID = [_id for _id in filteredTrophyTableIDs if _id in traceryIDs]
-            for _traceryID in traceryID:
-                filteredTrophyTableIDs.remove(_traceryID)
+        view = LootView(pages, container, level, _class, snapshot.version)
+        await interaction.response.send_message(embed=view.render(0), view=view)
+        view.message = await interaction.original_response()
 
+    @app_commands.command(name=_("simulate"), description=_("Simulates opening a container many times."))
+    @app_commands.guild_only()
+    @app_commands.describe(chest=_("The name of the container to open."), classes=_("The class opening the container."), level=_("The character level opening the container."), runs=_("The number of times to open the container."), item=_("Only show items with this in their name."))
+    @app_commands.autocomplete(chest=container_autocomplete)
+    async def simulate_respond(self, interaction: discord.Interaction, chest: str, classes: Optional[Classes]=Classes.Captain, level: Optional[app_commands.Range[int, 1, 160]]=160, runs: Optional[app_commands.Range[int, 100, 5000000]]=100000, item: Optional[str]=None):
+        snapshot = lootSnapshot
+        if chest not in snapshot.containers.keys():
+            await interaction.response.send_message(_("Unknown container."))
+            return
         _class = classes.name
-        queryClass = override_player_class(_class)
-        trophyListIDs = getTrophyListIDs(filteredTrophyTableIDs, trophyListIDs, queryClass, level)
-        loot = getItemDrops(trophyListIDs)
-        if not tracery and traceryID and level>=50:
-            if len(traceryID)==1:
-                loot.append((100, [_("A tracery (pass tracery=True to expand this list)")]))
-            else:
-                loot.append((100, [_("{0} traceries (pass tracery=True to expand this list)").format(len(traceryID))]))
-        loot = appendTreasureDrops(treasureListIDs, loot)
-        embed = generateLootEmbed(loot, containers[chest], level, _class)
-        if len(embed) > 6000:
-            # Check for send messages permission
-            perms = interaction.channel.permissions_for(interaction.guild.me)
-            if not (perms.send_messages and perms.embed_links):
-                content = _("Missing permissions to send multiple messages in this channel.")
-            else:
-                content = _("Large container, responding with multiple embeds...")
-            await interaction.response.send_message(content)
-            drops = 0
-            subloot = []
-            for chunk in loot:
-                # Roughly 200 drops fit in one embed, send and reset
-                if drops + len(chunk[1]) > 200:
-                    embed = generateLootEmbed(subloot, containers[chest], level, _class)
-                    await interaction.channel.send(embed=embed)
-                    drops = 0
-                    subloot = []
-                subloot.append(chunk)
-                drops += len(chunk[1])
-            embed = generateLootEmbed(subloot, containers[chest], level, _class)
-            await interaction.channel.send(embed=embed)
-        else:
-            await interaction.response.send_message(embed=embed)
+        rolls = getLootRolls(snapshot.data, chest, _class, level)
+        if not rolls:
+            await interaction.response.send_message(_("This container has no drops with a known chance."))
+            return
+        await interaction.response.defer(thinking=True)
+        async with self.simulations:
+            runs, results = await asyncio.to_thread(simulate, rolls, runs)
+        embed = generateSimulationEmbed(results, snapshot.containers[chest], level, _class, runs, item)
+        await interaction.followup.send(embed=embed)
+
+    @app_commands.command(name=_("drops"), description=_("Shows which containers drop an item."))
+    @app_commands.guild_only()
+    @app_commands.describe(item=_("The name of the item to find."))
+    @app_commands.autocomplete(item=item_autocomplete)
+    async def drops_respond(self, interaction: discord.Interaction, item: str):
+        snapshot = lootSnapshot
+        item = snapshot.itemIndex.fromChoice(item)
+        if item not in snapshot.itemIndex:
+            await interaction.response.send_message(_("Unknown item."))
+            return
+        embed = generateDropsEmbed(snapshot, item, snapshot.itemIndex.getDrops(item))
+        await interaction.response.send_message(embed=embed)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def reloadloot(self, ctx):
+        """Reloads lotro-data without restarting the bot"""
+        await ctx.send("Reloading loot data...")
+        try:
+            old, snapshot = await self.reload_loot()
+        except Exception as e:
+            logger.exception(e)
+            await ctx.send("Reloading failed, still using U{0}: {1}".format(lootSnapshot.version, e))
+            return
+        await ctx.send("Reloaded loot data, U{0} -> U{1} ({2} containers).".format(
+            old.version, snapshot.version, len(snapshot.containers)))
+
+class LootView(discord.ui.View):
+    """Pages through a drop table too large for one embed, pages are rendered on first view"""
+
+    def __init__(self, pages, container, level, classes, version):
+        super().__init__(timeout=600)
+        self.pages = pages
+        self.container = container
+        self.level = level
+        self.classes = classes
+        self.version = version
+        self.embeds = {}
+        self.page = 0
+        self.message = None
+        self.update_buttons()
+
+    def render(self, page):
+        embed = self.embeds.get(page)
+        if embed is None:
+            embed = generateLootEmbed(self.pages[page], self.container, self.level, self.classes, self.version, page,
+                                      len(self.pages))
+            self.embeds[page] = embed
+        return embed
+
+    def update_buttons(self):
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.page == len(self.pages) - 1
+
+    async def show(self, interaction, page):
+        self.page = page
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.render(page), view=self)
+
+    @discord.ui.button(emoji="\u25C0\uFE0F", style=discord.ButtonStyle.blurple)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="\u25B6\uFE0F", style=discord.ButtonStyle.blurple)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
 
 async def setup(bot):
     await bot.add_cog(TreasureCog(bot))
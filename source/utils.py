@@ -1,3 +1,9 @@
+import asyncio
+import functools
+import heapq
+import time
+
+from collections import Counter, OrderedDict
 from thefuzz import fuzz
 from thefuzz import process
 from thefuzz import utils
@@ -73,3 +79,131 @@ def get_partial_matches(word: str, word_list: list, score_cutoff: int = 75, limi
         else:
             return [match[0] for match in result]
     return result
+
+
+class LRUCache:
+    """A mapping holding at most maxsize entries, evicting the least recently used entry first."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class NgramIndex:
+    """An inverted index from n-grams to the entries of a dictionary, shortlists candidates for fuzzy matching.
+
+    Matches the results of get_partial_matches(word, entries, keys=True) while only scoring entries
+    that share n-grams with the word.
+    """
+
+    def __init__(self, entries: dict, n: int = 3, shortlist: int = 100):
+        self.n = n
+        self.shortlist = shortlist
+        self.names = {key: utils.full_process(value) for key, value in entries.items()}
+        self.positions = {key: i for i, key in enumerate(self.names)}
+        self.postings = {}
+        for key, name in self.names.items():
+            for gram in self.ngrams(name):
+                self.postings.setdefault(gram, []).append(key)
+
+    def ngrams(self, name: str):
+        return {name[i:i + self.n] for i in range(len(name) - self.n + 1)}
+
+    def search(self, word: str, score_cutoff: int = 75, limit: int = 25):
+        """Returns the keys of the best partial matches for word"""
+        query = utils.full_process(word)
+        if not query:
+            return []
+        if len(query) < self.n:
+            # Any entry containing a short word scores 100, nothing else reaches the cutoff
+            return [key for key, name in self.names.items() if query in name][:limit]
+        counts = Counter()
+        # Rarest n-grams first, common ones only add to the count of the candidates found so far
+        for gram in sorted(self.ngrams(query), key=lambda gram: len(self.postings.get(gram, ()))):
+            postings = self.postings.get(gram, ())
+            if len(counts) >= self.shortlist and len(postings) > len(counts):
+                for key in counts:
+                    if gram in self.names[key]:
+                        counts[key] += 1
+            else:
+                counts.update(postings)
+        candidates = heapq.nlargest(self.shortlist, counts, key=counts.get)
+        # Score in dictionary order so ties are broken the same way as get_partial_matches
+        candidates.sort(key=self.positions.get)
+        scores = []
+        for key in candidates:
+            score = fuzz.partial_ratio(query, self.names[key])
+            if score >= score_cutoff:
+                scores.append((score, key))
+        return [key for score, key in heapq.nlargest(limit, scores, key=lambda item: item[0])]
+
+
+class SingleFlight:
+    """Shares one in-flight call per key between concurrent callers.
+
+    A failed call is remembered for negative_ttl seconds, callers in that window get the same exception
+    instead of calling again.
+    """
+
+    def __init__(self, negative_ttl=30):
+        self.negative_ttl = negative_ttl
+        self.calls = {}
+        self.failures = {}
+        self.started = 0
+        self.coalesced = 0
+        self.negative_hits = 0
+
+    async def do(self, key, fetch):
+        """ await fetch() unless a call for key is already running, then await that call instead """
+        failure = self.failures.get(key)
+        if failure:
+            failed_at, exception = failure
+            if time.monotonic() < failed_at + self.negative_ttl:
+                self.negative_hits += 1
+                raise exception
+            del self.failures[key]
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            task.add_done_callback(functools.partial(self.done, key))
+            self.calls[key] = task
+            self.started += 1
+        else:
+            self.coalesced += 1
+        # A cancelled caller must not cancel the call the others are waiting for
+        return await asyncio.shield(task)
+
+    def done(self, key, task):
+        del self.calls[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.failures[key] = (time.monotonic(), task.exception())